@@ -4,11 +4,54 @@ __all__ = (
     "__version__",
     "add_file_extension",
     "install",
+    "get_included_files",
     "set_preprocessing_function",
+    "preprocess_many",
+    "configure",
+    "get_source_map",
+    "warmup",
 )
 
-from .runner import main, main_with_params
 from .version import __version__
 from .config import add_file_extension
-from .hooks import install
-from .preprocessor import set_preprocessing_function
+
+# other names are imported on first access to keep startup fast
+_LAZY_ATTRIBUTES = {
+    "main": "runner",
+    "main_with_params": "runner",
+    "install": "hooks",
+    "get_included_files": "hooks",
+    "set_preprocessing_function": "preprocessor",
+    "preprocess_many": "preprocessor",
+    "configure": "context",
+    "get_source_map": "sourcemap",
+    "warmup": "preload",
+}
+
+# typing takes a while to import, the constant is recognized by type checkers
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from .runner import main, main_with_params
+    from .hooks import install, get_included_files
+    from .preprocessor import set_preprocessing_function, preprocess_many
+    from .context import configure
+    from .sourcemap import get_source_map
+    from .preload import warmup
+
+
+def __getattr__(name: str):
+    try:
+        module_name = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(
+            f"module {__name__!r} has no attribute {name!r}"
+        ) from None
+    from importlib import import_module
+
+    value = getattr(import_module("." + module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import subprocess
+from time import perf_counter
+from typing import Dict, List, NamedTuple, Optional, TextIO
+
+from .version import __version__
+
+
+SCENARIOS = (
+    "startup_python",
+    "startup_pwcp",
+    "startup_pwcp_ppy",
+    "cold_import",
+    "warm_pyc_import",
+    "hash_pyc_import",
+    "exec",
+    "exec_disabled",
+    "repl_line",
+)
+
+
+class TreeParams(NamedTuple):
+    modules: int = 50
+    headers: int = 10
+    # headers included by each module
+    fanout: int = 3
+    macros: int = 50
+    # depth of nested #if blocks in each module
+    depth: int = 3
+
+
+def _generate_header(index: int, params: TreeParams) -> str:
+    lines = [f"#ifndef HEADER{index}", f"#define HEADER{index}"]
+    for i in range(params.macros):
+        lines.append(f"#define H{index}_CONST{i} {i}")
+        lines.append(f"#define H{index}_FUNC{i}(a, b) ((a) * {i} + (b))")
+    lines.append("#endif")
+    return "\n".join(lines) + "\n"
+
+
+def _generate_module(index: int, params: TreeParams) -> str:
+    headers = [(index + i) % params.headers for i in range(params.fanout)]
+    lines = [f'#include "bench_header{h}.pyh"' for h in headers]
+    lines.append("values = []")
+    for depth in range(params.depth):
+        lines.append(f"#if H{headers[0]}_CONST{depth % params.macros} >= 0")
+    for i in range(params.macros):
+        h = headers[i % len(headers)]
+        lines.append(f"values.append(H{h}_FUNC{i}(H{h}_CONST{i}, {i}))")
+    lines.extend("#endif" for _ in range(params.depth))
+    return "\n".join(lines) + "\n"
+
+
+def generate_tree(directory: str, params: TreeParams) -> None:
+    for i in range(params.headers):
+        with open(os.path.join(directory, f"bench_header{i}.pyh"), "w") as f:
+            f.write(_generate_header(i, params))
+    for i in range(params.modules):
+        with open(os.path.join(directory, f"bench_module{i}.ppy"), "w") as f:
+            f.write(_generate_module(i, params))
+    with open(os.path.join(directory, "bench_main.py"), "w") as f:
+        f.write("x = 1\n")
+    with open(os.path.join(directory, "bench_main.ppy"), "w") as f:
+        f.write("#define ONE 1\nx = ONE\n")
+
+
+# time to run a trivial script, measured from outside the interpreter
+_STARTUP_COMMANDS = {
+    "startup_python": ["{py}"],
+    # the same as pwcp script installed by pip
+    "startup_pwcp": ["-c", "from pwcp import main; main([{py!r}])"],
+    "startup_pwcp_ppy": ["-c", "from pwcp import main; main([{ppy!r}])"],
+}
+
+
+# executed in a fresh interpreter for every measurement,
+# prints time in seconds
+_SCENARIO_CODE = """
+import sys, time
+sys.path.insert(0, {tree!r})
+scenario, modules = {scenario!r}, {modules!r}
+sys.dont_write_bytecode = True
+
+import pwcp
+pwcp.install(
+    save_files=False,
+    prefer_python=False,
+    preprocess_unknown_sources=scenario in ("exec", "repl_line"),
+)
+
+if scenario.endswith("import"):
+    import importlib
+    start = time.perf_counter()
+    for i in range(modules):
+        importlib.import_module("bench_module" + str(i))
+    print(time.perf_counter() - start)
+elif scenario.startswith("exec"):
+    if scenario == "exec":
+        src = "#define ADD(a, b) ((a) + (b))\\n"
+        src += "#if 1\\nx = ADD(1, 2)\\n#endif\\n"
+    else:
+        src = "def add(a, b):\\n    return a + b\\nx = add(1, 2)\\n"
+    start = time.perf_counter()
+    for i in range(1000):
+        exec(src, {{}})
+    print((time.perf_counter() - start) / 1000)
+elif scenario == "repl_line":
+    import codeop
+    # the same path as interactive console
+    compiler = codeop.CommandCompiler()
+    compiler("#define ADD(a, b) ((a) + (b))\\n", "<input>", "single")
+    start = time.perf_counter()
+    for i in range(200):
+        compiler("x = ADD(" + str(i) + ", 1)\\n", "<input>", "single")
+    print((time.perf_counter() - start) / 200)
+"""
+
+
+def _clean_pycache(directory: str) -> None:
+    shutil.rmtree(os.path.join(directory, "__pycache__"), ignore_errors=True)
+
+
+def _compile_tree(directory: str, mode: str) -> None:
+    from py_compile import PycInvalidationMode
+    from .compileall import compile_files, find_files
+
+    _clean_pycache(directory)
+    for result in compile_files(
+        find_files([directory]), 1, PycInvalidationMode[mode], True
+    ):
+        if result.error is not None:
+            raise result.error
+
+
+def _run_scenario(scenario: str, tree: str, params: TreeParams) -> float:
+    env = os.environ.copy()
+    pwcp_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, (pwcp_root, env.get("PYTHONPATH")))
+    )
+    if scenario in _STARTUP_COMMANDS:
+        script = os.path.join(tree, "bench_main")
+        args = [
+            arg.format(py=script + ".py", ppy=script + ".ppy")
+            for arg in _STARTUP_COMMANDS[scenario]
+        ]
+        start = perf_counter()
+        subprocess.run([sys.executable, *args], env=env, check=True)
+        return perf_counter() - start
+
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            _SCENARIO_CODE.format(
+                tree=tree, scenario=scenario, modules=params.modules
+            ),
+        ],
+        env=env,
+    )
+    return float(output.splitlines()[-1])
+
+
+def run(
+    params: TreeParams = TreeParams(),
+    scenarios: Optional[List[str]] = None,
+    repeat: int = 3,
+    file: Optional[TextIO] = None,
+) -> dict:
+    """
+    Runs benchmarks, returning the best time of each scenario in seconds
+    """
+    if scenarios is None:
+        scenarios = SCENARIOS
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="pwcp-bench-") as tree:
+        generate_tree(tree, params)
+        for scenario in scenarios:
+            times = []
+            for _ in range(repeat):
+                if scenario == "warm_pyc_import":
+                    _compile_tree(tree, "TIMESTAMP")
+                elif scenario == "hash_pyc_import":
+                    _compile_tree(tree, "CHECKED_HASH")
+                else:
+                    _clean_pycache(tree)
+                times.append(_run_scenario(scenario, tree, params))
+            results[scenario] = min(times)
+            if file is not None:
+                print(
+                    f"{scenario:<20} {results[scenario] * 1000:10.3f} ms",
+                    file=file,
+                )
+    return {
+        "pwcp": __version__,
+        "python": platform.python_implementation()
+        + " "
+        + platform.python_version(),
+        "params": params._asdict(),
+        "results": results,
+    }
+
+
+def save(data: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def compare(old_path: str, new_path: str, file: TextIO) -> None:
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if old["params"] != new["params"]:
+        print("Warning: benchmarks were run with different params", file=file)
+    print(
+        f"{'scenario':<20} {old['pwcp']:>12} {new['pwcp']:>12} {'ratio':>8}",
+        file=file,
+    )
+    old_results: Dict[str, float] = old["results"]
+    for scenario, new_time in new["results"].items():
+        old_time = old_results.get(scenario)
+        if old_time is None:
+            continue
+        print(
+            f"{scenario:<20} {old_time * 1000:9.3f} ms {new_time * 1000:9.3f}"
+            f" ms {new_time / old_time:8.2f}",
+            file=file,
+        )
@@ -0,0 +1,379 @@
+"""
+Bundles: zip archives with code of preprocessed modules,
+which are imported without preprocessing and without looking
+at the file system; other files in the archive are left to zipimport
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import marshal
+import zipfile
+from collections import namedtuple
+from zipimport import zipimporter
+from importlib.abc import InspectLoader
+from importlib.machinery import SOURCE_SUFFIXES, ModuleSpec
+from importlib.util import MAGIC_NUMBER, spec_from_loader
+from types import CodeType
+
+try:
+    from importlib.resources.abc import ResourceReader
+except ImportError:
+    # before Python 3.11
+    from importlib.abc import ResourceReader
+
+from . import profiling
+from .config import FILE_EXTENSIONS
+from .version import __version__
+from .sourcemap import SourceMap, set_source_map
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+INDEX_MEMBER = "__pwcp__/index"
+CODE_PREFIX = "__pwcp__/code/"
+SOURCE_PREFIX = "__pwcp__/source/"
+
+
+BundleEntry = namedtuple(
+    "BundleEntry",
+    (
+        # path of the module in the archive, like in __file__
+        "path",
+        "is_package",
+        # files included by the module when it was bundled
+        "dependencies",
+        "source_map",
+    ),
+)
+
+
+def _module_name(path: str) -> Tuple[str, bool]:
+    name = os.path.splitext(path)[0].replace(os.sep, ".")
+    if name == "__init__" or name.endswith(".__init__"):
+        return name[: -len(".__init__")], True
+    return name, False
+
+
+def _is_package_dir(path: str) -> bool:
+    return any(
+        os.path.isfile(os.path.join(path, "__init__" + suffix))
+        for suffix in (*FILE_EXTENSIONS, *SOURCE_SUFFIXES)
+    )
+
+
+def _walk(root: str) -> Iterator[Tuple[str, str]]:
+    root = os.path.abspath(root)
+    # a package is bundled under its name
+    base = os.path.dirname(root) if _is_package_dir(root) else root
+    for parent, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for file in sorted(files):
+            path = os.path.join(parent, file)
+            yield path, os.path.relpath(path, base)
+
+
+def create_bundle(
+    output: str,
+    roots: Iterable[str],
+    compression: Optional[int] = None,
+) -> List[str]:
+    """
+    Preprocesses and compiles pwcp modules in the directories
+    and writes them to the archive together with other files,
+    returns names of the bundled pwcp modules.
+    Directories which are packages are bundled under their names.
+    Configuration (macros, compact mode) of the caller is used.
+    """
+    from .hooks import PPyLoader
+    from .store import preprocessed_files
+
+    if compression is None:
+        compression = zipfile.ZIP_DEFLATED
+
+    modules: Dict[str, tuple] = {}
+    tmp_output = f"{output}.{os.getpid()}.tmp"
+    try:
+        with zipfile.ZipFile(tmp_output, "w", compression) as archive:
+            for root in roots:
+                for path, rel_path in _walk(root):
+                    arc_path = rel_path.replace(os.sep, "/")
+                    if not path.endswith(tuple(FILE_EXTENSIONS)):
+                        # .py modules and package data
+                        archive.write(path, arc_path)
+                        continue
+                    name, is_package = _module_name(rel_path)
+                    loader = PPyLoader(name, path)
+                    data = loader.get_data(path)
+                    code = loader.source_to_code(data, path)
+                    archive.writestr(CODE_PREFIX + name, marshal.dumps(code))
+                    # for tracebacks
+                    archive.writestr(
+                        SOURCE_PREFIX + name, preprocessed_files[path]
+                    )
+                    modules[name] = tuple(
+                        BundleEntry(
+                            arc_path,
+                            is_package,
+                            [
+                                file
+                                for file in loader.dependencies or ()
+                                if os.path.isfile(file)
+                            ],
+                            (
+                                None
+                                if loader.source_map is None
+                                else tuple(loader.source_map)
+                            ),
+                        )
+                    )
+            # the index is read on every start, so it isn't compressed
+            archive.writestr(
+                INDEX_MEMBER,
+                marshal.dumps(
+                    {
+                        "magic": MAGIC_NUMBER,
+                        "version": __version__,
+                        "modules": modules,
+                    }
+                ),
+                zipfile.ZIP_STORED,
+            )
+        os.replace(tmp_output, output)
+    except BaseException:
+        try:
+            os.remove(tmp_output)
+        except OSError:
+            pass
+        raise
+    return list(modules)
+
+
+class Bundle:
+    """
+    Opened archive and its index
+    """
+
+    def __init__(self, archive: str) -> None:
+        try:
+            self.zip_file = zipfile.ZipFile(archive)
+        except (OSError, zipfile.BadZipFile):
+            raise ImportError("not a pwcp bundle", path=archive) from None
+        # plain zips are opened for every path entry, so they're closed
+        try:
+            index = self._read_index()
+        except BaseException:
+            self.zip_file.close()
+            raise
+        self.archive = archive
+        self.modules = {
+            name: BundleEntry(*entry)
+            for name, entry in index["modules"].items()
+        }
+
+    def _read_index(self) -> dict:
+        archive = self.zip_file.filename
+        try:
+            index = marshal.loads(self.zip_file.read(INDEX_MEMBER))
+        except (OSError, KeyError, EOFError, ValueError, zipfile.BadZipFile):
+            raise ImportError("not a pwcp bundle", path=archive) from None
+        if index.get("magic") != MAGIC_NUMBER:
+            raise ImportError(
+                "bundle was built by another version of Python", path=archive
+            )
+        # layout of the index and of the code may change between versions
+        if index.get("version") != __version__:
+            raise ImportError(
+                "bundle was built by another version of pwcp", path=archive
+            )
+        return index
+
+    def read(self, member: str) -> bytes:
+        return self.zip_file.read(member)
+
+
+# archive path -> bundle, shared by finders of its directories
+_bundles: Dict[str, Bundle] = {}
+
+
+def _get_bundle(archive: str) -> Bundle:
+    bundle = _bundles.get(archive)
+    if bundle is None:
+        # no lock is held while the archive is opened, imports done
+        # meanwhile look at the same path entry and come back here
+        new_bundle = Bundle(archive)
+        bundle = _bundles.setdefault(archive, new_bundle)
+        if bundle is not new_bundle:
+            new_bundle.zip_file.close()
+    return bundle
+
+
+class BundleLoader(InspectLoader):
+    def __init__(self, bundle: Bundle, name: str) -> None:
+        self.bundle = bundle
+        # name of the module, like in FileLoader
+        self.name = name
+        # importlib.resources of Python 3.9 looks for it, like in zipimporter
+        self.archive = bundle.archive
+
+    def _get_entry(self, fullname: str) -> BundleEntry:
+        try:
+            return self.bundle.modules[fullname]
+        except KeyError:
+            raise ImportError(
+                f"module {fullname!r} is not bundled", name=fullname
+            ) from None
+
+    def is_package(self, fullname: str) -> bool:
+        return self._get_entry(fullname).is_package
+
+    def get_code(self, fullname: str) -> CodeType:
+        from _imp import _fix_co_filename
+
+        entry = self._get_entry(fullname)
+        path = os.path.join(self.bundle.archive, entry.path)
+        # the same as reading a pyc, so it's reported in the same column
+        with profiling.stage(fullname, "read_pyc"):
+            code = marshal.loads(self.bundle.read(CODE_PREFIX + fullname))
+        # file names in the archive, like zipimport does
+        _fix_co_filename(code, path)
+        if entry.source_map is not None:
+            set_source_map(path, SourceMap(*entry.source_map))
+        return code
+
+    def get_source(self, fullname: str) -> str:
+        self._get_entry(fullname)
+        return self.bundle.read(SOURCE_PREFIX + fullname).decode()
+
+    def get_filename(self, fullname: str) -> str:
+        entry = self._get_entry(fullname)
+        return os.path.join(self.bundle.archive, entry.path)
+
+    def get_data(self, path: str) -> bytes:
+        # for pkgutil.get_data, paths are in the archive like __file__
+        prefix = self.bundle.archive + os.sep
+        if path.startswith(prefix):
+            member = path[len(prefix) :].replace(os.sep, "/")
+            try:
+                return self.bundle.read(member)
+            except KeyError:
+                pass
+        raise FileNotFoundError(path)
+
+    def get_resource_reader(
+        self, fullname: str
+    ) -> Optional["BundleResourceReader"]:
+        entry = self._get_entry(fullname)
+        if not entry.is_package:
+            return None
+        return BundleResourceReader(self.bundle, entry.path.rpartition("/")[0])
+
+
+class BundleResourceReader(ResourceReader):
+    """
+    Data files of bundled pwcp packages for importlib.resources
+    """
+
+    def __init__(self, bundle: Bundle, directory: str) -> None:
+        self.bundle = bundle
+        # "/"-separated, empty for the top level
+        self.prefix = directory + "/" if directory else ""
+
+    def open_resource(self, resource: str) -> io.BytesIO:
+        try:
+            return io.BytesIO(self.bundle.read(self.prefix + resource))
+        except KeyError:
+            raise FileNotFoundError(resource) from None
+
+    def resource_path(self, resource: str) -> str:
+        # resources aren't on the file system
+        raise FileNotFoundError(resource)
+
+    def is_resource(self, name: str) -> bool:
+        try:
+            return not self.bundle.zip_file.getinfo(
+                self.prefix + name
+            ).is_dir()
+        except KeyError:
+            return False
+
+    def contents(self) -> Iterator[str]:
+        names = {
+            name[len(self.prefix) :].partition("/")[0]
+            for name in self.bundle.zip_file.namelist()
+            if name.startswith(self.prefix)
+            and not name.startswith("__pwcp__/")
+        }
+        return iter(sorted(names - {""}))
+
+    def files(self) -> "zipfile.Path":
+        return zipfile.Path(self.bundle.archive, self.prefix)
+
+
+class BundleFinder:
+    """
+    Path entry finder for directories of bundles
+    """
+
+    def __init__(self, path: str, archive: str, prefix: str) -> None:
+        self.bundle = _get_bundle(archive)
+        self.path = path
+        # directory in the archive, "/"-separated
+        self.prefix = prefix
+        self._zipimporter: Optional[zipimporter] = None
+
+    def _get_zipimporter(self) -> Optional[zipimporter]:
+        if self._zipimporter is None:
+            try:
+                self._zipimporter = zipimporter(self.path)
+            except ImportError:
+                return None
+        return self._zipimporter
+
+    def find_spec(self, fullname: str, target=None) -> Optional[ModuleSpec]:
+        entry = self.bundle.modules.get(fullname)
+        if entry is None or self._get_directory(entry) != self.prefix:
+            return self._find_zip_spec(fullname, target)
+
+        spec = ModuleSpec(
+            fullname,
+            BundleLoader(self.bundle, fullname),
+            origin=os.path.join(self.bundle.archive, entry.path),
+            is_package=entry.is_package,
+        )
+        spec.has_location = True
+        if entry.is_package:
+            spec.submodule_search_locations = [os.path.dirname(spec.origin)]
+        return spec
+
+    def _find_zip_spec(
+        self, fullname: str, target=None
+    ) -> Optional[ModuleSpec]:
+        importer = self._get_zipimporter()
+        if importer is None:
+            return None
+        if hasattr(importer, "find_spec"):
+            return importer.find_spec(fullname, target)
+        # zipimporter has no find_spec before Python 3.10
+        loader, portions = importer.find_loader(fullname)
+        if loader is not None:
+            return spec_from_loader(fullname, loader)
+        if portions:
+            spec = ModuleSpec(fullname, None)
+            spec.submodule_search_locations = portions
+            return spec
+        return None
+
+    @staticmethod
+    def _get_directory(entry: BundleEntry) -> str:
+        directory = entry.path.rpartition("/")[0]
+        if entry.is_package:
+            directory = directory.rpartition("/")[0]
+        return directory
+
+    def invalidate_caches(self) -> None:
+        if self._zipimporter is not None:
+            self._zipimporter.invalidate_caches()
@@ -0,0 +1,111 @@
+import os
+import atexit
+import marshal
+import hashlib
+from typing import Dict, List, Optional, Tuple
+from importlib.util import MAGIC_NUMBER
+
+from pypp import __version__ as pypp_version
+
+from .version import __version__
+from .utils import file_hashes, get_file_hash, write_atomic
+
+
+# hashes depend on the magic number, so different Python versions
+# can't share them
+FILE_HASHES_NAME = "file-hashes-" + MAGIC_NUMBER.hex()
+
+# these change on every run and would make the cache useless,
+# bytecode caching freezes them in the same way
+VOLATILE_MACROS = frozenset(("__DATE__", "__TIME__", "__FILE__"))
+
+
+_persisted_dirs = set()
+
+
+def persist_file_hashes(directory: str) -> None:
+    if directory in _persisted_dirs:
+        return
+    _persisted_dirs.add(directory)
+
+    path = os.path.join(directory, FILE_HASHES_NAME)
+    file_hashes.load(path)
+    atexit.register(file_hashes.save, path)
+
+
+def hash_deps(deps: List[str]) -> Dict[str, Optional[bytes]]:
+    hashes = {}
+    for file in deps:
+        try:
+            hashes[file] = get_file_hash(file)
+        except OSError:
+            # include paths that were probed but don't exist
+            hashes[file] = None
+    return hashes
+
+
+def _macros_key(macros: dict) -> str:
+    return repr(
+        sorted(
+            (
+                name,
+                macro.arglist,
+                macro.variadic,
+                "".join(tok.value for tok in macro.value),
+            )
+            for name, macro in macros.items()
+            if name not in VOLATILE_MACROS
+        )
+    )
+
+
+class PreprocessedCache:
+    """
+    On-disk cache of preprocessed sources which can be shared
+    by several processes
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def make_key(self, src: str, filename: str, preprocessor, func) -> str:
+        h = hashlib.sha256()
+        for part in (
+            __version__,
+            pypp_version,
+            f"{func.__module__}.{func.__qualname__}",
+            filename,
+            repr(preprocessor.disabled),
+            repr(preprocessor.path),
+            repr(preprocessor.rewrite_paths),
+            _macros_key(preprocessor.macros),
+            src,
+        ):
+            h.update(part.encode("utf-8", "surrogatepass"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key: str) -> Optional[Tuple[str, List[str]]]:
+        try:
+            with open(self._get_path(key), "rb") as f:
+                hashes, text = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        deps = list(hashes)
+        if hash_deps(deps) != hashes:
+            return None
+        return text, deps
+
+    def put(self, key: str, text: str, deps: List[str]) -> None:
+        path = self._get_path(key)
+        data = marshal.dumps((hash_deps(deps), text))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # concurrent readers never see partial entries
+            write_atomic(path, data)
+        except OSError:
+            # the cache is optional, failing to write it is not an error
+            pass
@@ -0,0 +1,203 @@
+"""
+Compact mode: constant conditions left by conditional compilation
+are folded before compiling, and preprocessed sources are kept
+without blank lines, comments and #line directives,
+with a map to their line numbers
+"""
+
+import ast
+import sys
+import operator
+from array import array
+from types import CodeType
+from importlib.util import decode_source
+from typing import Iterable, List, NamedTuple, Tuple, Union
+
+from .monkeypatch import compile
+from .store import IndexedSource
+
+
+class CompactSource(NamedTuple):
+    text: str
+    # index of every line of the text in the full source,
+    # followed by number of lines in the full source
+    line_map: array
+
+    def to_lines(self) -> IndexedSource:
+        return IndexedSource(self.text, None, self.line_map)
+
+
+_UNARY_OPS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Invert: operator.invert,
+}
+# only operations which can't produce huge integers
+_BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.RShift: operator.rshift,
+}
+# identity checks of literals produce warnings, they're left as is
+_COMPARE_OPS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+}
+
+
+def _constant(value, node: ast.AST) -> ast.Constant:
+    return ast.copy_location(ast.Constant(value), node)
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """
+    Folds conditions like `0 and x > 1` or `0x030B00F0 >= 0x030A0000`,
+    so the compiler drops branches they disable.
+    The branches aren't removed here, because names bound in them
+    still affect scopes.
+    """
+
+    def __init__(self, optimize: int) -> None:
+        self.debug = optimize == 0
+        # (first, last) lines of multiline strings
+        self.string_spans: List[Tuple[int, int]] = []
+
+    def _add_span(self, node: ast.expr) -> None:
+        # end positions are missing before Python 3.8
+        end_lineno = getattr(node, "end_lineno", None)
+        if end_lineno is None:
+            self.string_spans.append((node.lineno, sys.maxsize))
+        elif end_lineno > node.lineno:
+            self.string_spans.append((node.lineno, node.end_lineno))
+
+    def visit_Constant(self, node: ast.Constant) -> ast.AST:
+        if isinstance(node.value, (str, bytes)):
+            self._add_span(node)
+        return node
+
+    def visit_JoinedStr(self, node: ast.JoinedStr) -> ast.AST:
+        # positions of f-string parts aren't reliable
+        self._add_span(node)
+        return node
+
+    # string nodes before Python 3.8
+    visit_Str = visit_Bytes = visit_JoinedStr
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id == "__debug__" and isinstance(node.ctx, ast.Load):
+            return _constant(self.debug, node)
+        return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.operand, ast.Constant):
+            try:
+                return _constant(
+                    _UNARY_OPS[type(node.op)](node.operand.value), node
+                )
+            except Exception:
+                pass
+        return node
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        op = _BINARY_OPS.get(type(node.op))
+        if (
+            op is not None
+            and isinstance(node.left, ast.Constant)
+            and isinstance(node.right, ast.Constant)
+            and type(node.left.value) is int
+            and type(node.right.value) is int
+        ):
+            try:
+                return _constant(op(node.left.value, node.right.value), node)
+            except Exception:
+                pass
+        return node
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        self.generic_visit(node)
+        operands = [node.left, *node.comparators]
+        if not all(isinstance(operand, ast.Constant) for operand in operands):
+            return node
+        try:
+            result = True
+            for op, left, right in zip(node.ops, operands, operands[1:]):
+                result = _COMPARE_OPS[type(op)](left.value, right.value)
+                if not result:
+                    break
+        except Exception:
+            return node
+        if type(result) is not bool:
+            return node
+        return _constant(result, node)
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        is_and = isinstance(node.op, ast.And)
+        values = node.values
+        # leading constants either decide the result or are skipped
+        while len(values) > 1 and isinstance(values[0], ast.Constant):
+            if bool(values[0].value) != is_and:
+                return values[0]
+            values = values[1:]
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+
+def compact_source(
+    text: str, string_spans: Iterable[Tuple[int, int]] = ()
+) -> CompactSource:
+    """
+    Removes blank and comment-only lines from the source,
+    except ones inside multiline strings spanning the given lines
+    """
+    lines = text.split("\n")
+    # the last line has no separator
+    if lines[-1] == "":
+        lines.pop()
+    protected = bytearray(len(lines))
+    for first, last in string_spans:
+        # the first line has the start of the string
+        last = min(last, len(lines))
+        protected[first:last] = b"\1" * (last - first)
+    kept = []
+    line_map = array("Q")
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if protected[index] or stripped and not stripped.startswith("#"):
+            kept.append(line)
+            line_map.append(index)
+    line_map.append(len(lines))
+    return CompactSource("".join(line + "\n" for line in kept), line_map)
+
+
+def compile_compact(
+    data: Union[bytes, bytearray, str], path: str, optimize: int = -1
+) -> Tuple[CodeType, CompactSource]:
+    """
+    Compiles the preprocessed source with constant conditions folded,
+    returns the code and the compacted source.
+    Line numbers of the code refer to the full source.
+    """
+    if optimize == -1:
+        optimize = sys.flags.optimize
+    tree = compile(data, path, "exec", ast.PyCF_ONLY_AST, dont_inherit=True)
+    folder = ConstantFolder(optimize)
+    tree = folder.visit(tree)
+    code = compile(tree, path, "exec", dont_inherit=True, optimize=optimize)
+    if not isinstance(data, str):
+        data = decode_source(data)
+    return code, compact_source(data, folder.string_spans)
@@ -0,0 +1,190 @@
+import os
+import time
+from py_compile import PycInvalidationMode
+from importlib._bootstrap_external import _classify_pyc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from .config import FILE_EXTENSIONS
+from .context import configure
+from .utils import write_atomic
+from .store import get_line_index_path, write_line_index
+from .hooks import PPyLoader
+from .depgraph import get_dependency_graph
+from .monkeypatch import (
+    read_pyc_trailer,
+    patched_cache_from_source,
+    patched_code_to_hash_pyc,
+    patched_code_to_timestamp_pyc,
+    patched_validate_hash_pyc,
+    patched_validate_timestamp_pyc,
+)
+
+
+class CompileResult(NamedTuple):
+    path: str
+    # "compiled", "up-to-date" or "failed"
+    status: str
+    elapsed: float
+    error: Optional[BaseException] = None
+    dependencies: Optional[List[str]] = None
+
+
+def _get_valid_pyc_dependencies(
+    path: str, pyc_path: str, invalidation_mode: PycInvalidationMode
+) -> Optional[List[str]]:
+    """
+    Returns dependencies recorded in the pyc if it's up to date
+    """
+    try:
+        with open(pyc_path, "rb") as f:
+            data = f.read()
+        st = os.stat(path)
+    except OSError:
+        return None
+    trailer = read_pyc_trailer(data)
+    if trailer is None:
+        return None
+
+    exc_details = {"name": path, "path": pyc_path}
+    try:
+        flags = _classify_pyc(data, path, exc_details)
+        if flags == 0:
+            if invalidation_mode != PycInvalidationMode.TIMESTAMP:
+                return None
+            patched_validate_timestamp_pyc(
+                data, int(st.st_mtime), st.st_size, path, exc_details
+            )
+        else:
+            checked = invalidation_mode == PycInvalidationMode.CHECKED_HASH
+            if invalidation_mode == PycInvalidationMode.TIMESTAMP or (
+                bool(flags & 0b10) != checked
+            ):
+                return None
+            patched_validate_hash_pyc(data, None, path, exc_details)
+    except (ImportError, EOFError):
+        return None
+    return list(trailer[1])
+
+
+def compile_file(
+    path: str,
+    invalidation_mode: PycInvalidationMode = PycInvalidationMode.TIMESTAMP,
+    force: bool = False,
+    cache_dir: Optional[str] = None,
+    macros: Tuple[Tuple[str, Optional[str]], ...] = (),
+    compact: bool = False,
+) -> CompileResult:
+    with configure(cache_dir=cache_dir, macros=macros, compact=compact):
+        return _compile_file(path, invalidation_mode, force)
+
+
+def _compile_file(
+    path: str, invalidation_mode: PycInvalidationMode, force: bool
+) -> CompileResult:
+    start = time.perf_counter()
+    pyc_path = patched_cache_from_source(path)
+    if not force:
+        deps = _get_valid_pyc_dependencies(path, pyc_path, invalidation_mode)
+        if deps is not None:
+            return CompileResult(
+                path, "up-to-date", time.perf_counter() - start, None, deps
+            )
+
+    try:
+        mtime = int(os.stat(path).st_mtime)
+        name = os.path.splitext(os.path.basename(path))[0]
+        loader = PPyLoader(name, path)
+        source_bytes = loader.get_data(path)
+        # this also registers dependencies of the code object
+        code = loader.source_to_code(source_bytes, path)
+        if invalidation_mode == PycInvalidationMode.TIMESTAMP:
+            data = patched_code_to_timestamp_pyc(
+                code, mtime, len(source_bytes)
+            )
+        else:
+            data = patched_code_to_hash_pyc(
+                code,
+                None,
+                invalidation_mode == PycInvalidationMode.CHECKED_HASH,
+            )
+        os.makedirs(os.path.dirname(pyc_path), exist_ok=True)
+        write_atomic(pyc_path, data)
+        write_line_index(
+            get_line_index_path(pyc_path), *loader.get_line_data(source_bytes)
+        )
+    except Exception as e:
+        return CompileResult(path, "failed", time.perf_counter() - start, e)
+
+    return CompileResult(
+        path,
+        "compiled",
+        time.perf_counter() - start,
+        None,
+        loader.dependencies,
+    )
+
+
+def find_files(paths: Iterable[str]) -> Iterator[str]:
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path)
+            continue
+        for parent, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            for file in sorted(files):
+                if file.endswith(tuple(FILE_EXTENSIONS)):
+                    yield os.path.abspath(os.path.join(parent, file))
+
+
+def compile_files(
+    paths: Iterable[str],
+    workers: Optional[int] = None,
+    invalidation_mode: PycInvalidationMode = PycInvalidationMode.TIMESTAMP,
+    force: bool = False,
+    cache_dir: Optional[str] = None,
+    macros: Tuple[Tuple[str, Optional[str]], ...] = (),
+    compact: bool = False,
+) -> Iterator[CompileResult]:
+    """
+    Compiles given files on a process pool, yielding results as they complete.
+    If cache directory is given, dependency graph in it is updated.
+    """
+    graph = (
+        None if cache_dir is None else get_dependency_graph(cache_dir, macros)
+    )
+    for result in _compile_files(
+        list(paths),
+        workers,
+        invalidation_mode,
+        force,
+        cache_dir,
+        macros,
+        compact,
+    ):
+        if graph is not None and result.dependencies is not None:
+            graph.update(result.path, result.dependencies)
+        yield result
+
+
+def _compile_files(
+    paths: List[str],
+    workers: Optional[int],
+    invalidation_mode: PycInvalidationMode,
+    force: bool,
+    cache_dir: Optional[str],
+    macros: Tuple[Tuple[str, Optional[str]], ...],
+    compact: bool,
+) -> Iterator[CompileResult]:
+    args = invalidation_mode, force, cache_dir, macros, compact
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            yield compile_file(path, *args)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(compile_file, path, *args) for path in paths
+        ]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Iterator, Optional
+
+
+# field -> default value, see Config
+_CONFIG_DEFAULTS = {
+    # save .ppy files to .py after preprocessing
+    "save_files": False,
+    # directory for caching preprocessed files between runs
+    "cache_dir": None,
+    # socket of pwcp serve daemon
+    "daemon": None,
+    # preprocess code even if filename is unknown (for example, in exec)
+    "preprocess_unknown_sources": False,
+    # None means the built-in one, see set_preprocessing_function
+    "preprocessing_function": None,
+    # preprocess imported files in chunks of this many characters,
+    # None disables streaming
+    "stream_chunk_size": None,
+    # reuse macros defined by leading lines of modules, see pwcp.pch
+    "precompiled_headers": False,
+    # (name, value) pairs applied to every preprocessor in order,
+    # None value undefines the macro; pycs of .ppy files get
+    # a separate optimization tag for every set of macros
+    "macros": (),
+    # fold constant conditions in imported files and keep their
+    # sources without empty lines, see pwcp.compact
+    "compact": False,
+}
+
+
+# namedtuple is used instead of typing.NamedTuple,
+# because typing is slow to import
+class Config(
+    namedtuple("Config", _CONFIG_DEFAULTS, defaults=_CONFIG_DEFAULTS.values())
+):
+    """
+    Snapshot of pwcp configuration.
+    It's immutable, so it can be read from any thread without locking,
+    changes replace the whole snapshot.
+    """
+
+    __slots__ = ()
+
+
+_default_config = Config()
+# only writers take the lock, so changes aren't lost
+_default_lock = threading.Lock()
+# configuration of current thread or task, if it's overridden
+_config_override: ContextVar[Optional[Config]] = ContextVar(
+    "pwcp_config", default=None
+)
+
+
+def get_config() -> Config:
+    config = _config_override.get()
+    if config is None:
+        return _default_config
+    return config
+
+
+def set_default_config(**changes) -> Config:
+    """
+    Changes configuration of all threads which don't override it,
+    returns the previous configuration
+    """
+    global _default_config
+
+    with _default_lock:
+        prev_config = _default_config
+        _default_config = prev_config._replace(**changes)
+    return prev_config
+
+
+@contextmanager
+def configure(**changes) -> Iterator[Config]:
+    """
+    Overrides configuration in current thread or task
+    """
+    token = _config_override.set(get_config()._replace(**changes))
+    try:
+        yield get_config()
+    finally:
+        _config_override.reset(token)
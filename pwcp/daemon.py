@@ -0,0 +1,196 @@
+import os
+import socket
+import marshal
+import socketserver
+from importlib.util import MAGIC_NUMBER
+from typing import Any, Dict, List, Optional, Tuple
+
+from .utils import LRUCache
+from .version import __version__
+from .context import Config, configure, get_config
+
+
+LENGTH_SIZE = 4
+CLIENT_TIMEOUT = 30
+
+# (path, optimize, preprocessed text) -> marshalled code
+code_cache = LRUCache(256)
+
+# configuration which changes results of preprocessing,
+# requests carry values of the client
+CONFIG_FIELDS = ("save_files", "cache_dir", "precompiled_headers", "macros")
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock: socket.socket, message: Any) -> None:
+    data = marshal.dumps(message)
+    sock.sendall(len(data).to_bytes(LENGTH_SIZE, "little") + data)
+
+
+def recv_message(sock: socket.socket) -> Any:
+    size = int.from_bytes(_recv_exact(sock, LENGTH_SIZE), "little")
+    return marshal.loads(_recv_exact(sock, size))
+
+
+def _preprocess(path: str, config: Dict[str, Any]) -> Tuple[str, List[str]]:
+    from .preprocessor import preprocess_file
+
+    if set(config) != set(CONFIG_FIELDS):
+        raise ValueError("unexpected configuration fields")
+    macros = tuple(map(tuple, config["macros"]))
+    with configure(**{**config, "macros": macros}) as config:
+        return preprocess_file(path, config.save_files, config.cache_dir)
+
+
+def _compile(
+    path: str, optimize: int, config: Dict[str, Any]
+) -> Tuple[str, List[str], bytes]:
+    from .monkeypatch import compile
+
+    text, deps = _preprocess(path, config)
+    key = (path, optimize, text)
+    code = code_cache.get(key)
+    if code is None:
+        code = code_cache[key] = marshal.dumps(
+            compile(text, path, "exec", dont_inherit=True, optimize=optimize)
+        )
+    return text, deps, code
+
+
+OPERATIONS = {
+    "ping": lambda: True,
+    "preprocess": _preprocess,
+    "compile": _compile,
+}
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    """
+    Handles a request of form
+    (magic number, pwcp version, cwd, operation, args),
+    responding with (True, result) or (False, error description)
+    """
+
+    def handle(self) -> None:
+        try:
+            magic, version, cwd, operation, args = recv_message(self.request)
+        except (EOFError, ValueError, TypeError, OSError):
+            return
+        try:
+            if magic != MAGIC_NUMBER:
+                raise ValueError("client uses another Python version")
+            if version != __version__:
+                raise ValueError("client uses another pwcp version")
+            # paths in preprocessor are relative to working directory
+            os.chdir(cwd)
+            response = True, OPERATIONS[operation](*args)
+        except Exception as e:
+            response = False, f"{type(e).__name__}: {e}"
+        try:
+            send_message(self.request, response)
+        except OSError:
+            pass
+
+
+class Server(socketserver.TCPServer):
+    # the same as socketserver.UnixStreamServer,
+    # which doesn't exist on platforms without Unix sockets
+    address_family = getattr(socket, "AF_UNIX", None)
+
+    # requests are handled one by one, so shared state
+    # of preprocessor doesn't need locking
+    def server_bind(self) -> None:
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+        super().server_bind()
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def serve(address: str) -> None:
+    """
+    Serves preprocessing requests on Unix socket until interrupted
+    """
+    # keep pypp and hooks loaded between requests
+    from . import preprocessor  # noqa: F401
+
+    with Server(address, RequestHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+class DaemonClient:
+    """
+    Sends requests to the daemon, returning None
+    if it's unavailable or failed, so the caller can do the work itself
+    """
+
+    def __init__(self, address: str, timeout: float = CLIENT_TIMEOUT) -> None:
+        self.address = address
+        self.timeout = timeout
+
+    def request(self, operation: str, *args) -> Optional[Any]:
+        if not hasattr(socket, "AF_UNIX"):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.address)
+                send_message(
+                    sock,
+                    (MAGIC_NUMBER, __version__, os.getcwd(), operation, args),
+                )
+                ok, result = recv_message(sock)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return result if ok else None
+
+    def ping(self) -> bool:
+        return self.request("ping") is True
+
+    @staticmethod
+    def _get_fields(config: Optional[Config]) -> Dict[str, Any]:
+        if config is None:
+            config = get_config()
+        return {field: getattr(config, field) for field in CONFIG_FIELDS}
+
+    def preprocess(
+        self, path: str, config: Optional[Config] = None
+    ) -> Optional[Tuple[str, List[str]]]:
+        """
+        Preprocesses the file with the configuration
+        (current one by default)
+        """
+        result = self.request("preprocess", path, self._get_fields(config))
+        return None if result is None else tuple(result)
+
+    def compile(
+        self, path: str, optimize: int, config: Optional[Config] = None
+    ) -> Optional[Tuple[str, List[str], bytes]]:
+        """
+        Preprocesses and compiles the file with the configuration
+        (current one by default)
+        """
+        result = self.request(
+            "compile", path, optimize, self._get_fields(config)
+        )
+        return None if result is None else tuple(result)
@@ -0,0 +1,159 @@
+import os
+import sys
+import atexit
+import marshal
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .utils import write_atomic
+from .context import get_config
+from .monkeypatch import get_optimization_tag, patched_cache_from_source
+
+
+DEPGRAPH_NAME = "depgraph"
+
+FileSignature = Optional[Tuple[int, int]]
+
+
+def _get_signature(file: str) -> FileSignature:
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class DependencyGraph:
+    """
+    Persistent graph of modules and files they include,
+    used to find modules affected by changes in headers
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # module -> {file: signature when the module was preprocessed}
+        # for the module itself and every file it includes
+        self.modules: Dict[str, Dict[str, FileSignature]] = {}
+        # included file -> modules
+        self.dependents: Dict[str, Set[str]] = {}
+        self._updated: Set[str] = set()
+        # modules can be imported by several threads at once
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "rb") as f:
+                modules = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        with self._lock:
+            for module in self._updated:
+                modules[module] = self.modules[module]
+            self.modules = {}
+            self.dependents = {}
+            for module, files in modules.items():
+                self._add(module, files)
+
+    def save(self) -> None:
+        with self._lock:
+            # merge changes made by other processes
+            self.load()
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                write_atomic(self.path, marshal.dumps(self.modules))
+            except OSError:
+                pass
+            self._updated.clear()
+
+    def _add(self, module: str, files: Dict[str, FileSignature]) -> None:
+        self.modules[module] = files
+        for file in files:
+            if file != module:
+                self.dependents.setdefault(file, set()).add(module)
+
+    def _remove(self, module: str) -> None:
+        for file in self.modules.pop(module, ()):
+            if file != module:
+                self.dependents[file].discard(module)
+
+    def update(self, module: str, deps: Iterable[str]) -> None:
+        files = {file: _get_signature(file) for file in (module, *deps)}
+        with self._lock:
+            self._remove(module)
+            self._add(module, files)
+            self._updated.add(module)
+
+    def get_dependencies(self, module: str) -> List[str]:
+        return [
+            file for file in self.modules.get(module, ()) if file != module
+        ]
+
+    def get_dependents(self, file: str) -> Set[str]:
+        return set(self.dependents.get(file, ()))
+
+    def find_outdated(self, modules: Iterable[str]) -> List[str]:
+        """
+        Returns modules which need to be preprocessed again
+        because they or files they include changed
+        """
+        signatures = {}
+
+        def is_changed(file: str, signature: FileSignature) -> bool:
+            try:
+                current = signatures[file]
+            except KeyError:
+                current = signatures[file] = _get_signature(file)
+            return current != signature
+
+        outdated = []
+        for module in modules:
+            files = self.modules.get(module)
+            if (
+                files is None
+                or not os.path.exists(patched_cache_from_source(module))
+                or any(is_changed(*item) for item in files.items())
+            ):
+                outdated.append(module)
+        return outdated
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def get_graph_name(
+    macros: Tuple[Tuple[str, Optional[str]], ...], optimize: int
+) -> str:
+    """
+    Returns file name of the graph of pycs built with the macros,
+    every flavour of pycs needs its own signatures
+    """
+    if macros:
+        return f"{DEPGRAPH_NAME}.{get_optimization_tag(macros, optimize)}"
+    if optimize:
+        return f"{DEPGRAPH_NAME}.opt-{optimize}"
+    return DEPGRAPH_NAME
+
+
+def get_dependency_graph(
+    cache_dir: str,
+    macros: Optional[Tuple[Tuple[str, Optional[str]], ...]] = None,
+) -> DependencyGraph:
+    """
+    Returns the graph stored in cache directory, saving it at exit.
+    Macros of the current configuration are used by default.
+    """
+    if macros is None:
+        macros = get_config().macros
+    path = os.path.join(cache_dir, get_graph_name(macros, sys.flags.optimize))
+    try:
+        return _graphs[path]
+    except KeyError:
+        pass
+    with _graphs_lock:
+        graph = _graphs.get(path)
+        if graph is None:
+            graph = _graphs[path] = DependencyGraph(path)
+            atexit.register(graph.save)
+    return graph
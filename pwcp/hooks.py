@@ -3,11 +3,15 @@
 # https://stackoverflow.com/a/45168493/
 # https://stackoverflow.com/a/48671982/
 
+from __future__ import annotations
+
 import os
 import sys
-from types import CodeType
-from typing import Callable, Optional
+import marshal
+from collections import namedtuple
+from types import CodeType, ModuleType
 from importlib import invalidate_caches
+from importlib._bootstrap import _call_with_frames_removed
 from importlib.machinery import (
     BYTECODE_SUFFIXES,
     SOURCE_SUFFIXES,
@@ -16,58 +20,395 @@ from importlib.machinery import (
     SourceFileLoader,
 )
 
+from . import profiling
 from .config import FILE_EXTENSIONS
-from .preprocessor import PyPreprocessor, preprocess, preprocess_file
+from .context import get_config, set_default_config
+from .store import (
+    get_line_index_path,
+    preprocessed_files,
+    write_line_index,
+)
+from .utils import LRUCache
 from .monkeypatch import (
     apply_monkeypatch,
     dependencies,
+    read_pyc_trailer,
+    source_maps,
+    compile as unpatched_compile,
 )
 
+# pypp and other heavy modules are imported on demand
+# to keep startup fast when no .ppy files are used
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import (
+        Callable,
+        Dict,
+        Iterable,
+        List,
+        Optional,
+        Tuple,
+        Union,
+    )
+    from array import array
+
+    from .compact import CompactSource
+    from .daemon import DaemonClient
+    from .sourcemap import SourceMap
+
+
+def _get_daemon_client(address: str) -> "DaemonClient":
+    from .daemon import DaemonClient
+
+    return DaemonClient(address)
+
+
+class WarmCode(
+    namedtuple(
+        "WarmCode",
+        (
+            "code",
+            # modification time of the source when it was read
+            "mtime",
+            "dependencies",
+            "source_map",
+        ),
+    )
+):
+    """
+    Code of module compiled before it's imported, see pwcp.warmup
+    """
+
+    __slots__ = ()
+
 
 class PPyLoader(SourceFileLoader):
-    save_files = False
+    # source path -> code compiled in advance, used once
+    warm_code: Dict[str, WarmCode] = {}
 
     def __init__(
         self, fullname: str, path: str, *, command_line: Optional[str] = None
     ) -> None:
         super().__init__(fullname, path)
         self.command_line = command_line
+        # files included by the module, including the probed ones,
+        # from the last preprocessing or from the pyc
+        self.dependencies: Optional[List[str]] = None
+        # lines of the preprocessed source to original files,
+        # from the last preprocessing or from the pyc
+        self.source_map: Optional["SourceMap"] = None
+        # source returned by get_data and code compiled by the daemon
+        self._daemon_code: Optional[Tuple[bytes, bytes]] = None
+        # source to write line index from when bytecode is cached
+        self._line_data: Optional[bytes] = None
+        # source compacted by source_to_code in compact mode
+        self._compact: Optional["CompactSource"] = None
+
+    def _preprocess(self) -> Tuple[Union[bytes, bytearray], List[str]]:
+        config = get_config()
+        # the daemon runs the built-in preprocessor on whole files
+        use_daemon = (
+            config.daemon is not None
+            and config.preprocessing_function is None
+            and config.stream_chunk_size is None
+        )
+        if use_daemon and config.compact:
+            # the code is compiled here with constant conditions folded
+            result = _get_daemon_client(config.daemon).preprocess(
+                self.path, config
+            )
+            if result is not None:
+                text, deps = result
+                preprocessed_files[self.path] = text
+                return text.encode(), deps
+        elif use_daemon:
+            result = _get_daemon_client(config.daemon).compile(
+                self.path, sys.flags.optimize, config
+            )
+            if result is not None:
+                text, deps, code = result
+                preprocessed_files[self.path] = text
+                self._daemon_code = text.encode(), code
+                return self._daemon_code[0], deps
+
+        if config.stream_chunk_size is not None:
+            from .preprocessor import preprocess_file_streaming
+
+            return preprocess_file_streaming(
+                self.path, config.save_files, config.stream_chunk_size
+            )
+
+        from .preprocessor import preprocess_file
+
+        data, deps = preprocess_file(
+            self.path, config.save_files, config.cache_dir
+        )
+        return data.encode(), deps
+
+    def get_code(self, fullname: str) -> Optional[CodeType]:
+        warm = self.warm_code.pop(self.path, None)
+        if warm is not None and warm.mtime == _get_mtime(self.path):
+            profiling.count("warm_hits", 1, self.name)
+            self.dependencies = warm.dependencies
+            self.source_map = warm.source_map
+            return warm.code
+        return super().get_code(fullname)
 
     def get_data(self, filename: str) -> Optional[bytes]:
         if filename == "-c":
+            from .preprocessor import preprocess
+
             return preprocess(self.command_line, filename)[0].encode()
 
         if filename.endswith(tuple(BYTECODE_SUFFIXES)):
-            with open(filename, "rb") as f:
-                return f.read()
+            with profiling.stage(self.name, "read_pyc"):
+                with open(filename, "rb") as f:
+                    data = f.read()
+                trailer = read_pyc_trailer(data)
+                if trailer is not None:
+                    self.dependencies = list(trailer[1])
+                    if trailer[2] is not None:
+                        from .sourcemap import SourceMap, set_source_map
+
+                        self.source_map = SourceMap(*trailer[2])
+                        set_source_map(self.path, self.source_map)
+            # if the pyc is outdated, this is replaced after preprocessing
+            index_path = get_line_index_path(filename)
+            # pycs of older versions and other tools have no index
+            if os.path.isfile(index_path):
+                preprocessed_files.set_index_file(self.path, index_path)
+            return data
+
+        with profiling.stage(self.name, "preprocess"):
+            from .sourcemap import SourceMap, set_source_map
+
+            data, self.dependencies = self._preprocess()
+            self.source_map = SourceMap.from_source(data, self.path)
+            set_source_map(self.path, self.source_map)
+            cache_dir = get_config().cache_dir
+            if cache_dir is not None:
+                from .depgraph import get_dependency_graph
 
-        data, deps = preprocess_file(self.path, self.save_files)
-        dependencies[self.path] = deps
+                get_dependency_graph(cache_dir).update(
+                    self.path, self.dependencies
+                )
+        profiling.count("includes", len(self.dependencies), self.name)
+        profiling.count("bytes", len(data), self.name)
 
-        return data.encode()
+        return data
 
-    def source_to_code(self, data: bytes, path: str, *args) -> CodeType:
-        code = super().source_to_code(data, path, *args)
-        if self.path in dependencies:
-            dependencies[code] = dependencies.pop(self.path)
+    def source_to_code(
+        self, data: bytes, path: str, *, _optimize: int = -1
+    ) -> CodeType:
+        daemon_code, self._daemon_code = self._daemon_code, None
+        self._compact = None
+        # data is already preprocessed, so patched compile mustn't be used
+        with profiling.stage(self.name, "compile"):
+            if (
+                daemon_code is not None
+                and daemon_code[0] is data
+                and _optimize == -1
+            ):
+                code = marshal.loads(daemon_code[1])
+            elif get_config().compact:
+                from .compact import compile_compact
+
+                code, self._compact = _call_with_frames_removed(
+                    compile_compact, data, path, _optimize
+                )
+                # full source isn't kept, lines are restored from the map
+                preprocessed_files.set_lines(
+                    self.path, self._compact.to_lines()
+                )
+            else:
+                code = _call_with_frames_removed(
+                    unpatched_compile,
+                    data,
+                    path,
+                    "exec",
+                    dont_inherit=True,
+                    optimize=_optimize,
+                )
+        if self.dependencies is not None:
+            dependencies[code] = self.dependencies
+        if self.source_map is not None:
+            source_maps[code] = self.source_map
+        if not sys.dont_write_bytecode:
+            self._line_data = data
         return code
 
+    def set_data(self, path: str, data: bytes, *, _mode: int = 0o666):
+        super().set_data(path, data, _mode=_mode)
+        line_data, self._line_data = self._line_data, None
+        if line_data is not None and path.endswith(tuple(BYTECODE_SUFFIXES)):
+            # lines are mapped from it when the module is loaded from pyc
+            index_path = get_line_index_path(path)
+            try:
+                write_line_index(index_path, *self.get_line_data(line_data))
+            except OSError:
+                # an index of an older compile would show wrong lines
+                try:
+                    os.remove(index_path)
+                except OSError:
+                    pass
+
+    def get_line_data(self, data: bytes) -> Tuple[bytes, Optional["array"]]:
+        """
+        Returns source compiled from the data for writing line index,
+        and its line map if it's compacted
+        """
+        if self._compact is None:
+            return data, None
+        return self._compact.text.encode(), self._compact.line_map
+
+
+def get_included_files(module: ModuleType) -> List[str]:
+    """
+    Returns paths of all files included by the module, directly or not
+    """
+    loader = getattr(module.__spec__, "loader", None)
+    if not isinstance(loader, PPyLoader) or loader.dependencies is None:
+        return []
+    # skip include paths that were probed but don't exist
+    return [file for file in loader.dependencies if os.path.isfile(file)]
+
 
 LOADER_DETAILS = PPyLoader, FILE_EXTENSIONS
 
 
+DirectoryIndex = namedtuple(
+    "DirectoryIndex",
+    (
+        "mtime",
+        # modules with pwcp extensions
+        "modules",
+        # subdirectories, which may be pwcp packages
+        "subdirs",
+    ),
+)
+
+
+def _index_directory(directory: str, mtime: int) -> DirectoryIndex:
+    modules = set()
+    subdirs = set()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            for ext in FILE_EXTENSIONS:
+                if entry.name.endswith(ext):
+                    modules.add(entry.name[: -len(ext)])
+            try:
+                if entry.is_dir():
+                    subdirs.add(entry.name)
+            except OSError:
+                pass
+    return DirectoryIndex(mtime, frozenset(modules), frozenset(subdirs))
+
+
+def _split_archive_path(path: str) -> Optional[Tuple[str, str]]:
+    """
+    Splits path entry like app.zip/package to archive path
+    and "/"-separated directory in it
+    """
+    archive = path
+    parts = []
+    while not os.path.isfile(archive):
+        parent, name = os.path.split(archive)
+        if not name or parent == archive:
+            return None
+        parts.append(name)
+        archive = parent
+    return archive, "/".join(reversed(parts))
+
+
+def _bundle_path_hook(path: str):
+    # directories are the most common case, they're left to FileFinder
+    split = None if os.path.isdir(path) else _split_archive_path(path)
+    if split is None:
+        raise ImportError("not a pwcp bundle", path=path)
+    from .bundle import BundleFinder
+
+    return BundleFinder(path, *split)
+
+
+def _get_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
 class PPyPathFinder(PathFinder):
     """
     An overridden PathFinder which will hunt for ppy files in sys.path
     """
 
     hook = FileFinder.path_hook(LOADER_DETAILS)
-    cache = {}
+    # path entry -> FileFinder or None
+    cache = LRUCache(256)
+    # directory -> its listing, so directories without pwcp modules
+    # are skipped without asking FileFinder
+    index: Dict[str, DirectoryIndex] = {}
+    # package directory -> (mtime, whether it has pwcp __init__)
+    packages: Dict[str, Tuple[int, bool]] = {}
 
     @classmethod
     def invalidate_caches(cls):
         super().invalidate_caches()
         cls.cache.clear()
+        cls.index.clear()
+        cls.packages.clear()
+
+    @classmethod
+    def _get_index(cls, directory: str) -> Optional[DirectoryIndex]:
+        # this is called for every path entry on every import,
+        # so it's inlined _get_mtime
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        index = cls.index.get(directory)
+        if index is None or index.mtime != mtime:
+            try:
+                index = cls.index[directory] = _index_directory(
+                    directory, mtime
+                )
+            except OSError:
+                return None
+        return index
+
+    @classmethod
+    def _is_package(cls, directory: str) -> bool:
+        mtime = _get_mtime(directory)
+        if mtime is None:
+            return False
+        try:
+            cached_mtime, result = cls.packages[directory]
+        except KeyError:
+            pass
+        else:
+            if cached_mtime == mtime:
+                return result
+        result = any(
+            os.path.isfile(os.path.join(directory, "__init__" + ext))
+            for ext in FILE_EXTENSIONS
+        )
+        cls.packages[directory] = mtime, result
+        return result
+
+    @classmethod
+    def _may_contain(cls, path: str, name: str) -> bool:
+        """
+        Returns False if path entry certainly has no pwcp module
+        or package with the name
+        """
+        index = cls._get_index(path)
+        if index is None:
+            return False
+        if name in index.modules:
+            return True
+        return name in index.subdirs and cls._is_package(
+            os.path.join(path, name)
+        )
 
     @classmethod
     def _path_hooks(cls, path):
@@ -83,20 +424,41 @@ class PPyPathFinder(PathFinder):
                 path = os.getcwd()
             except FileNotFoundError:
                 return None
-        try:
-            finder = cls.cache[path]
-        except KeyError:
+        finder = cls.cache.get(path, cls)
+        if finder is cls:
             finder = cls.cache[path] = cls._path_hooks(path)
         return finder
 
+    @classmethod
+    def _find_spec(cls, fullname: str, path: Optional[list], target):
+        if path is None:
+            path = sys.path
+        name = fullname.rpartition(".")[2]
+        for entry in path:
+            if not isinstance(entry, str):
+                continue
+            if entry == "":
+                try:
+                    entry = os.getcwd()
+                except FileNotFoundError:
+                    continue
+            if not cls._may_contain(entry, name):
+                continue
+            finder = cls._path_importer_cache(entry)
+            if finder is None:
+                continue
+            spec = finder.find_spec(fullname, target)
+            # namespace packages are left to the standard finder
+            if spec is not None and spec.loader is not None:
+                return spec
+        return None
+
     @classmethod
     def find_spec(
         cls, fullname: str, path: Optional[list] = None, target=None
     ):
-        spec = super().find_spec(fullname, path, target)
-        if spec is not None and spec.loader is not None:
-            return spec
-        return None
+        with profiling.stage(fullname, "find_spec"):
+            return cls._find_spec(fullname, path, target)
 
 
 def _install() -> Callable[..., None]:
@@ -107,12 +469,31 @@ def _install() -> Callable[..., None]:
         save_files: bool,
         prefer_python: bool,
         preprocess_unknown_sources: bool,
+        cache_dir: Optional[str] = None,
+        daemon: Optional[str] = None,
+        stream_chunk_size: Optional[int] = None,
+        precompiled_headers: bool = False,
+        macros: Iterable[Tuple[str, Optional[str]]] = (),
+        compact: bool = False,
     ):
         nonlocal done
 
-        # (re)setting global configuration
-        PPyLoader.save_files = save_files
-        PyPreprocessor.default_disabled = not preprocess_unknown_sources
+        # (re)setting global configuration,
+        # threads can still override it with pwcp.configure
+        set_default_config(
+            save_files=save_files,
+            cache_dir=cache_dir,
+            daemon=daemon,
+            preprocess_unknown_sources=preprocess_unknown_sources,
+            stream_chunk_size=stream_chunk_size,
+            precompiled_headers=precompiled_headers,
+            macros=tuple(macros),
+            compact=compact,
+        )
+        if cache_dir is not None:
+            from .cache import persist_file_hashes
+
+            persist_file_hashes(cache_dir)
 
         # insert the path finder
         try:
@@ -129,6 +510,11 @@ def _install() -> Callable[..., None]:
 
         # register our extension
         SOURCE_SUFFIXES.extend(FILE_EXTENSIONS)
+        # bundles are zip archives, so the hook must precede zipimport
+        sys.path_hooks.insert(0, _bundle_path_hook)
+        for path in list(sys.path_importer_cache):
+            if isinstance(path, str) and os.path.isfile(path):
+                del sys.path_importer_cache[path]
         # clear any loaders that might already be in use by the FileFinder
         invalidate_caches()
         # patch standard library
@@ -1,32 +1,75 @@
+from __future__ import annotations
+
 import os
+import sys
 import codeop
+import weakref
 import marshal
 import builtins
 import functools
 import linecache
-from io import BytesIO
-from _imp import source_hash
 from builtins import compile, eval, exec
 from linecache import getlines
 from codeop import Compile, _maybe_compile
 from importlib import _bootstrap_external
 from importlib._bootstrap_external import (
+    cache_from_source,
     _code_to_timestamp_pyc,
     _validate_timestamp_pyc,
     _code_to_hash_pyc,
     _validate_hash_pyc,
 )
 
-from .preprocessor import PyPreprocessor, maybe_preprocess, preprocessed_files
+from . import profiling
 from .config import FILE_EXTENSIONS
-from .utils import py_from_ppy_filename
+from .context import get_config
+from .store import preprocessed_files
+from .utils import get_file_hash, needs_preprocessing, py_from_ppy_filename
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Callable, Optional, Tuple
 
 
-dependencies = {}
+# dependencies of code objects which will be written to pycs,
+# every code object is only registered and popped by the thread importing it
+dependencies = weakref.WeakKeyDictionary()
+# source maps of code objects, registered and popped the same way
+source_maps = weakref.WeakKeyDictionary()
 
 BYTECODE_HEADER_LENGTH = 16
 BYTECODE_SIZE_LENGTH = 4
-RAW_MAGIC_NUMBER = int.from_bytes(_bootstrap_external.MAGIC_NUMBER, "little")
+# pwcp pycs end with marshalled dependency info and source map,
+# its size and this magic,
+# so they can be recognized without unmarshalling the code object
+PYC_TRAILER_MAGIC = b"\0pwcpdep"
+PYC_TRAILER_SIZE_LENGTH = 4
+PREPROCESSOR_MODULE = __package__ + ".preprocessor"
+
+
+def maybe_preprocess(src, filename, preprocessor=None):
+    """
+    The same as preprocessor.maybe_preprocess,
+    but doesn't load pypp while there's nothing to preprocess
+    """
+    if not isinstance(src, (str, bytes)):
+        # for example, code object
+        return src
+    if preprocessor is None and not needs_preprocessing(
+        src, filename, not get_config().preprocess_unknown_sources
+    ):
+        # the output would be the same, so skip all the work
+        return src
+    module = sys.modules.get(PREPROCESSOR_MODULE)
+    if module is None or not hasattr(module, "maybe_preprocess"):
+        # if another thread is importing the preprocessor,
+        # this waits until the import is finished
+        from . import preprocessor as module
+
+        if not hasattr(module, "maybe_preprocess"):
+            # pypp compiles its own code while this thread imports it
+            return src
+    return module.maybe_preprocess(src, filename, preprocessor)
 
 
 @functools.wraps(getlines)
@@ -34,15 +77,16 @@ def patched_getlines(filename, module_globals=None):
     if filename is None:
         return []
 
-    filename = os.path.abspath(filename)
+    if filename not in preprocessed_files:
+        filename = os.path.abspath(filename)
     if filename in preprocessed_files:
-        content = preprocessed_files[filename]
-        if content is None:
+        lines = preprocessed_files.get_lines(filename)
+        if lines is None:
             # preprocessing failed, show original code
             return getlines(filename, module_globals)
-        return content.splitlines()
+        return lines
 
-    if PPyLoader.save_files:
+    if get_config().save_files:
         py_filename = py_from_ppy_filename(filename)
         if os.path.isfile(py_filename):
             return getlines(py_filename, module_globals)
@@ -95,6 +139,8 @@ def patched_maybe_compile(compiler, src, filename, *args, **kwargs):
 @functools.wraps(Compile, updated=())
 class patched_Compile(Compile):
     def __init__(self):
+        from .preprocessor import PyPreprocessor
+
         super().__init__()
         self.preprocessor = PyPreprocessor()
 
@@ -107,13 +153,71 @@ def _get_file_mtime(file: str) -> int:
     return os.stat(file).st_mtime_ns
 
 
+def _get_deps_info(deps: list, get_info: Callable) -> dict:
+    info = {}
+    for file in deps:
+        try:
+            info[file] = get_info(file)
+        except FileNotFoundError:
+            # include paths that were probed but don't exist
+            info[file] = None
+    return info
+
+
+def _make_pyc_trailer(
+    source_path: str, deps_info: dict, source_map: Optional[tuple] = None
+) -> bytes:
+    if source_map is not None:
+        # named tuples can't be marshalled
+        source_map = tuple(source_map)
+    data = marshal.dumps((source_path, deps_info, source_map))
+    return (
+        data
+        + len(data).to_bytes(PYC_TRAILER_SIZE_LENGTH, "little")
+        + PYC_TRAILER_MAGIC
+    )
+
+
+def read_pyc_trailer(
+    data: bytes,
+) -> Optional[Tuple[str, dict, Optional[tuple]]]:
+    if data[-len(PYC_TRAILER_MAGIC) :] != PYC_TRAILER_MAGIC:
+        return None
+    end = len(data) - len(PYC_TRAILER_MAGIC) - PYC_TRAILER_SIZE_LENGTH
+    size = int.from_bytes(data[end : end + PYC_TRAILER_SIZE_LENGTH], "little")
+    if end - size < BYTECODE_HEADER_LENGTH:
+        return None
+    try:
+        trailer = marshal.loads(data[end - size : end])
+    except (EOFError, ValueError, TypeError):
+        return None
+    if len(trailer) == 2:
+        # written by older versions
+        return (*trailer, None)
+    return trailer
+
+
+def _check_deps(deps_info: dict, get_info: Callable) -> bool:
+    for file, info in deps_info.items():
+        try:
+            current_info = get_info(file)
+        except FileNotFoundError:
+            # either the path was only probed or the include
+            # will fail anyway, so there's no point in recompiling
+            continue
+        if info != current_info:
+            return False
+    return True
+
+
 @functools.wraps(_code_to_timestamp_pyc)
 def patched_code_to_timestamp_pyc(code, mtime=0, source_size=0):
     data = _code_to_timestamp_pyc(code, mtime, source_size)
-    if code in dependencies:
-        deps = dependencies.pop(code)
-        mtimes = {file: _get_file_mtime(file) for file in deps}
-        data.extend(marshal.dumps(mtimes))
+    deps = dependencies.pop(code, None)
+    source_map = source_maps.pop(code, None)
+    if deps is not None:
+        mtimes = _get_deps_info(deps, _get_file_mtime)
+        data.extend(_make_pyc_trailer(code.co_filename, mtimes, source_map))
     return data
 
 
@@ -121,10 +225,18 @@ def patched_code_to_timestamp_pyc(code, mtime=0, source_size=0):
 def patched_validate_timestamp_pyc(
     data, source_mtime, source_size, name, exc_details
 ):
-    data_f = BytesIO(data[BYTECODE_HEADER_LENGTH:])
-    code = marshal.load(data_f)
-    is_pwcp_pyc = code.co_filename.endswith(tuple(FILE_EXTENSIONS))
-    if is_pwcp_pyc:
+    with profiling.stage(name, "validate"):
+        _validate_timestamp_pyc_with_deps(
+            data, source_mtime, source_size, name, exc_details
+        )
+
+
+def _validate_timestamp_pyc_with_deps(
+    data, source_mtime, source_size, name, exc_details
+):
+    trailer = read_pyc_trailer(data)
+    if trailer is not None:
+        # the size in header is the size of preprocessed source
         source_size = int.from_bytes(
             data[
                 BYTECODE_HEADER_LENGTH
@@ -134,63 +246,68 @@ def patched_validate_timestamp_pyc(
             signed=False,
         )
     _validate_timestamp_pyc(data, source_mtime, source_size, name, exc_details)
-    if is_pwcp_pyc:
-        mtimes = marshal.load(data_f)
-        for file, mtime in mtimes.items():
-            try:
-                current_mtime = _get_file_mtime(file)
-            except FileNotFoundError:
-                continue
-            if mtime != current_mtime:
-                raise ImportError(
-                    f"bytecode is stale for {name!r}", **exc_details
-                )
-
-
-def _get_file_hash(file):
-    with open(file, "rb") as f:
-        return source_hash(RAW_MAGIC_NUMBER, f.read())
+    if trailer is not None and not _check_deps(trailer[1], _get_file_mtime):
+        raise ImportError(f"bytecode is stale for {name!r}", **exc_details)
 
 
 @functools.wraps(_code_to_hash_pyc)
 def patched_code_to_hash_pyc(code, source_hash, checked=True):
-    if code in dependencies:
-        source_hash = _get_file_hash(code.co_filename)
+    deps = dependencies.pop(code, None)
+    source_map = source_maps.pop(code, None)
+    if deps is not None:
+        source_hash = get_file_hash(code.co_filename)
     data = _code_to_hash_pyc(code, source_hash, checked)
-    if code in dependencies:
-        deps = dependencies.pop(code)
-        hashes = {file: _get_file_hash(file) for file in deps}
-        data.extend(marshal.dumps(hashes))
+    if deps is not None:
+        hashes = _get_deps_info(deps, get_file_hash)
+        data.extend(_make_pyc_trailer(code.co_filename, hashes, source_map))
     return data
 
 
 @functools.wraps(_validate_hash_pyc)
 def patched_validate_hash_pyc(data, source_hash, name, exc_details):
-    data_f = BytesIO(data[BYTECODE_HEADER_LENGTH:])
-    code = marshal.load(data_f)
-    is_pwcp_pyc = code.co_filename.endswith(tuple(FILE_EXTENSIONS))
-    if is_pwcp_pyc:
-        source_hash = _get_file_hash(code.co_filename)
+    with profiling.stage(name, "validate"):
+        _validate_hash_pyc_with_deps(data, source_hash, name, exc_details)
+
+
+def _validate_hash_pyc_with_deps(data, source_hash, name, exc_details):
+    trailer = read_pyc_trailer(data)
+    if trailer is not None:
+        source_hash = get_file_hash(trailer[0])
     _validate_hash_pyc(data, source_hash, name, exc_details)
-    if is_pwcp_pyc:
-        hashes = marshal.load(data_f)
-        for file, hash_ in hashes.items():
-            try:
-                current_hash = _get_file_hash(file)
-            except FileNotFoundError:
-                continue
-            if hash_ != current_hash:
-                raise ImportError(
-                    f"hash in bytecode doesn't match hash of source {name!r}",
-                    **exc_details,
-                )
+    if trailer is not None and not _check_deps(trailer[1], get_file_hash):
+        raise ImportError(
+            f"hash in bytecode doesn't match hash of source {name!r}",
+            **exc_details,
+        )
 
 
-def apply_monkeypatch():
-    global PPyLoader
+@functools.lru_cache(maxsize=None)
+def get_optimization_tag(macros: tuple, optimize: int) -> str:
+    """
+    Returns optimization tag of pycs compiled with predefined macros
+    """
+    import hashlib
+
+    digest = hashlib.sha256(repr(macros).encode()).hexdigest()[:16]
+    # tags must be alphanumeric
+    return f"{optimize or ''}m{digest}"
 
-    from .hooks import PPyLoader
 
+@functools.wraps(cache_from_source)
+def patched_cache_from_source(path, debug_override=None, *, optimization=None):
+    if (
+        optimization is None
+        and debug_override is None
+        and os.fspath(path).endswith(tuple(FILE_EXTENSIONS))
+    ):
+        macros = get_config().macros
+        if macros:
+            # flavours built with different macros are cached side by side
+            optimization = get_optimization_tag(macros, sys.flags.optimize)
+    return cache_from_source(path, debug_override, optimization=optimization)
+
+
+def apply_monkeypatch():
     linecache.getlines = patched_getlines
 
     builtins.compile = patched_compile
@@ -199,6 +316,7 @@ def apply_monkeypatch():
     codeop._maybe_compile = patched_maybe_compile
     codeop.Compile = patched_Compile
 
+    _bootstrap_external.cache_from_source = patched_cache_from_source
     _bootstrap_external._code_to_timestamp_pyc = patched_code_to_timestamp_pyc
     _bootstrap_external._validate_timestamp_pyc = (
         patched_validate_timestamp_pyc
@@ -0,0 +1,242 @@
+"""
+Precompiled headers: macros defined by leading #include, #define
+and #undef lines of modules are saved and reused by other modules
+which start with the same lines
+"""
+
+import os
+import re
+import marshal
+import hashlib
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
+
+from pypp import __version__ as pypp_version
+from pypp.parser import LexToken, Macro
+
+from . import profiling
+from .version import __version__
+from .cache import VOLATILE_MACROS, _macros_key
+from .utils import LRUCache, write_atomic
+from .monkeypatch import _check_deps, _get_deps_info, _get_file_mtime
+
+if TYPE_CHECKING:
+    from .preprocessor import PyPreprocessor
+
+
+PCH_DIR_NAME = "pch"
+
+PRELUDE_LINE = re.compile(r"\s*(#\s*(include|define|undef)\b.*)?")
+INCLUDE_LINE = re.compile(r"\s*#\s*include\b")
+
+
+class PrecompiledHeader(NamedTuple):
+    macros: Dict[str, Macro]
+    include_once: dict
+    included_files: List[str]
+    disabled: bool
+    countermacro: int
+    # mtimes of included files, checked like in pyc trailers
+    deps_info: dict
+
+
+# key -> header or None if the prelude can't be precompiled
+headers = LRUCache(64)
+_MISSING = object()
+
+
+def split_prelude(src: str) -> Tuple[str, int]:
+    """
+    Returns leading lines of the source which only include files
+    and (un)define macros, and their number.
+    There's no prelude if no file is included.
+    """
+    pos = 0
+    count = 0
+    has_include = False
+    while pos < len(src):
+        end = src.find("\n", pos)
+        end = len(src) if end == -1 else end + 1
+        line = src[pos:end].rstrip()
+        # continued lines and comments aren't worth handling
+        if line.endswith("\\") or not PRELUDE_LINE.fullmatch(line):
+            break
+        has_include = has_include or bool(INCLUDE_LINE.match(line))
+        pos = end
+        count += 1
+    if not has_include:
+        return "", 0
+    return src[:pos], count
+
+
+def make_key(prelude: str, filename: str, p: "PyPreprocessor") -> str:
+    h = hashlib.sha256()
+    for part in (
+        __version__,
+        pypp_version,
+        # relative includes are resolved from the directory of the module
+        os.path.dirname(os.path.abspath(filename)),
+        repr(p.disabled),
+        repr(p.path),
+        repr(p.rewrite_paths),
+        _macros_key(p.macros),
+        prelude,
+    ):
+        h.update(part.encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _build(
+    prelude: str, filename: str, p: "PyPreprocessor"
+) -> Optional[PrecompiledHeader]:
+    from .preprocessor import _preprocess
+
+    builder = type(p)(disabled=p.disabled)
+    builder.macros.update(p.macros)
+    builder.path = list(p.path)
+    builder.rewrite_paths = list(p.rewrite_paths)
+    try:
+        output = _preprocess(prelude, filename, builder)
+    except Exception:
+        # the error is reported when the module is preprocessed as usual
+        return None
+    if output and not output.isspace():
+        # included files produce code, it can't be skipped
+        return None
+    return PrecompiledHeader(
+        {
+            name: macro
+            for name, macro in builder.macros.items()
+            if name not in VOLATILE_MACROS
+        },
+        dict(builder.include_once),
+        list(builder.included_files),
+        builder.disabled,
+        builder.countermacro,
+        _get_deps_info(builder.included_files, _get_file_mtime),
+    )
+
+
+def _dump_token(tok: LexToken) -> dict:
+    # tokens can reference the lexer
+    return {k: v for k, v in vars(tok).items() if k != "lexer"}
+
+
+def _load_token(data: dict) -> LexToken:
+    tok = object.__new__(LexToken)
+    tok.__dict__.update(data)
+    return tok
+
+
+def _dump(header: Optional[PrecompiledHeader]) -> Optional[tuple]:
+    if header is None:
+        return None
+    macros = {
+        name: (
+            {k: v for k, v in vars(macro).items() if k != "value"},
+            [_dump_token(tok) for tok in macro.value],
+        )
+        for name, macro in header.macros.items()
+    }
+    return (macros, *header[1:])
+
+
+def _load(data: Optional[tuple]) -> Optional[PrecompiledHeader]:
+    if data is None:
+        return None
+    macros = {}
+    for name, (attrs, value) in data[0].items():
+        macro = macros[name] = object.__new__(Macro)
+        macro.__dict__.update(attrs)
+        macro.value = [_load_token(tok) for tok in value]
+    return PrecompiledHeader(macros, *data[1:])
+
+
+def _read(path: str) -> Optional[PrecompiledHeader]:
+    try:
+        with open(path, "rb") as f:
+            version, data = marshal.load(f)
+        if version != __version__:
+            return _MISSING
+        return _load(data)
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        return _MISSING
+
+
+def _write(path: str, header: Optional[PrecompiledHeader]) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, marshal.dumps((__version__, _dump(header))))
+    except (OSError, ValueError):
+        # precompiled headers are optional
+        pass
+
+
+def _is_valid(header: Optional[PrecompiledHeader]) -> bool:
+    # failed preludes also depend on files, but most likely
+    # they'll fail again, so they aren't rechecked
+    return header is None or _check_deps(header.deps_info, _get_file_mtime)
+
+
+def get_precompiled_header(
+    prelude: str,
+    filename: str,
+    p: "PyPreprocessor",
+    cache_dir: Optional[str] = None,
+) -> Optional[PrecompiledHeader]:
+    """
+    Returns state of the preprocessor after the prelude,
+    building it if there's no valid one in memory or in cache directory
+    """
+    key = make_key(prelude, filename, p)
+    header = headers.get(key, _MISSING)
+    if header is not _MISSING and _is_valid(header):
+        profiling.count("pch_hits")
+        return header
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, PCH_DIR_NAME, key[:2], key[2:])
+        header = _read(path)
+        if header is not _MISSING and _is_valid(header):
+            profiling.count("pch_hits")
+            headers[key] = header
+            return header
+
+    profiling.count("pch_misses")
+    header = headers[key] = _build(prelude, filename, p)
+    if path is not None:
+        _write(path, header)
+    return header
+
+
+def apply_precompiled_header(
+    src: str,
+    filename: str,
+    p: "PyPreprocessor",
+    cache_dir: Optional[str] = None,
+) -> str:
+    """
+    Seeds the preprocessor with the state after prelude of the source,
+    returns the source with the prelude replaced by empty lines
+    """
+    prelude, count = split_prelude(src)
+    if not count:
+        return src
+    header = get_precompiled_header(prelude, filename, p, cache_dir)
+    if header is None:
+        return src
+
+    # macros are shared between preprocessors like header macros
+    volatile = {
+        name: p.macros[name] for name in VOLATILE_MACROS if name in p.macros
+    }
+    p.macros.clear()
+    p.macros.update(header.macros)
+    p.macros.update(volatile)
+    p.include_once.update(header.include_once)
+    p.included_files.extend(header.included_files)
+    p.disabled = header.disabled
+    p.countermacro = header.countermacro
+    # line numbers stay the same
+    return "\n" * count + src[len(prelude) :]
@@ -0,0 +1,178 @@
+"""
+Preprocessing and compiling modules in the background,
+so importing them later doesn't block
+"""
+
+import sys
+import marshal
+import threading
+from importlib.machinery import ModuleSpec, PathFinder
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional
+
+from .context import Config, configure, get_config
+from .hooks import PPyLoader, PPyPathFinder, WarmCode, _get_mtime
+from .sourcemap import SourceMap, set_source_map
+from .store import preprocessed_files
+
+
+class _ProcessResult(NamedTuple):
+    path: str
+    mtime: Optional[int]
+    # marshalled code
+    code: bytes
+    dependencies: Optional[List[str]]
+    source_map: Optional[tuple]
+    text: Optional[str]
+
+
+def _get_search_path(package: str) -> Optional[List[str]]:
+    module = sys.modules.get(package)
+    if module is not None:
+        return getattr(module, "__path__", None)
+    parent = package.rpartition(".")[0]
+    path = sys.path
+    if parent:
+        path = _get_search_path(parent)
+        if path is None:
+            return None
+    # the package itself is imported later, by the import system
+    for finder in (PPyPathFinder, PathFinder):
+        spec = finder.find_spec(package, path)
+        if spec is not None:
+            return spec.submodule_search_locations
+    return None
+
+
+def _find_spec(name: str) -> Optional[ModuleSpec]:
+    """
+    Finds spec of pwcp module without importing its parent packages
+    """
+    parent = name.rpartition(".")[0]
+    path = None
+    if parent:
+        path = _get_search_path(parent)
+        if path is None:
+            return None
+    return PPyPathFinder.find_spec(name, path)
+
+
+def _warm_in_thread(name: str, config: Config) -> bool:
+    with configure(**config._asdict()):
+        spec = _find_spec(name)
+        if spec is None:
+            return False
+        loader = spec.loader
+        # changes made after this are noticed on import
+        mtime = _get_mtime(loader.path)
+        try:
+            # reads or writes pyc like a usual import
+            code = loader.get_code(name)
+        except Exception:
+            # the error is raised again on import
+            return False
+    PPyLoader.warm_code[loader.path] = WarmCode(
+        code, mtime, loader.dependencies, loader.source_map
+    )
+    return True
+
+
+def _warm_in_process(name: str, config: Config) -> Optional[_ProcessResult]:
+    with configure(**config._asdict()):
+        spec = _find_spec(name)
+        if spec is None:
+            return None
+        loader = spec.loader
+        mtime = _get_mtime(loader.path)
+        try:
+            # pycs aren't used, patched validation isn't applied here
+            data = loader.get_data(loader.path)
+            code = loader.source_to_code(data, loader.path)
+        except Exception:
+            return None
+    return _ProcessResult(
+        loader.path,
+        mtime,
+        marshal.dumps(code),
+        loader.dependencies,
+        None if loader.source_map is None else tuple(loader.source_map),
+        preprocessed_files.get(loader.path),
+    )
+
+
+def _save_process_result(result: Optional[_ProcessResult]) -> bool:
+    if result is None:
+        return False
+    source_map = None
+    if result.source_map is not None:
+        source_map = SourceMap(*result.source_map)
+        set_source_map(result.path, source_map)
+    # for tracebacks, like after preprocessing in this process
+    preprocessed_files[result.path] = result.text
+    PPyLoader.warm_code[result.path] = WarmCode(
+        marshal.loads(result.code),
+        result.mtime,
+        result.dependencies,
+        source_map,
+    )
+    return True
+
+
+def warmup(
+    module_names: Iterable[str], executor: Optional[Executor] = None
+) -> "Future[List[str]]":
+    """
+    Preprocesses and compiles the modules in the executor
+    (a new thread pool by default), so importing them later
+    only executes the code. Parent packages aren't imported.
+    Returns a future of names of modules that were warmed up,
+    the others are imported as usual; use asyncio.wrap_future
+    to await it in an event loop.
+    """
+    names = list(module_names)
+    result: "Future[List[str]]" = Future()
+    result.set_running_or_notify_cancel()
+    if not names:
+        result.set_result([])
+        return result
+
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(thread_name_prefix="pwcp-warmup")
+    in_process = isinstance(executor, ProcessPoolExecutor)
+    func = _warm_in_process if in_process else _warm_in_thread
+    # workers don't share context with this thread
+    config = get_config()
+    futures = [executor.submit(func, name, config) for name in names]
+    if own_executor:
+        # threads exit when the work is done
+        executor.shutdown(wait=False)
+
+    remaining = len(futures)
+    lock = threading.Lock()
+
+    def on_done(_: Future) -> None:
+        nonlocal remaining
+
+        with lock:
+            remaining -= 1
+            if remaining:
+                return
+        try:
+            warmed = []
+            for name, future in zip(names, futures):
+                done = future.result()
+                if in_process:
+                    done = _save_process_result(done)
+                if done:
+                    warmed.append(name)
+        except BaseException as e:
+            result.set_exception(e)
+        else:
+            result.set_result(warmed)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return result
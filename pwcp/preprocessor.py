@@ -1,26 +1,240 @@
+import os
+import time
+import hashlib
+import threading
 from io import StringIO
+from copy import copy
+from contextlib import ExitStack
 from linecache import getline
-from importlib.machinery import SOURCE_SUFFIXES
-from typing import Any, Callable, Optional, TextIO, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 from pypp import Preprocessor
 
-from .config import FILE_EXTENSIONS
-from .utils import py_from_ppy_filename
+from . import profiling
+from .context import Config, configure, get_config, set_default_config
+from .cache import PreprocessedCache, hash_deps
+from .pch import apply_precompiled_header
+from .store import preprocessed_files
+from .utils import (
+    LRUCache,
+    get_disabled,
+    needs_preprocessing,
+    py_from_ppy_filename,
+)
 from .errors import PreprocessorError
 
 
-preprocessed_files = {}
+# token lines and macro definitions of included files,
+# keyed by (file name, file content)
+header_cache = LRUCache(128)
+# results of preprocessing strings with a fresh preprocessor,
+# keyed by (digest of source, file name, configuration),
+# so sources aren't kept alive
+string_cache = LRUCache(256)
+# default size of chunks in streaming mode, in characters
+STREAM_CHUNK_SIZE = 1024 * 1024
+# predefined macros -> [(name, macro or None if undefined)]
+predefined_cache = LRUCache(16)
 
 
-class PyPreprocessor(Preprocessor):
-    default_disabled = True
+def _copy_line(line: list) -> list:
+    # copy.copy is too slow for this
+    new_line = []
+    for tok in line:
+        new_tok = object.__new__(type(tok))
+        new_tok.__dict__.update(tok.__dict__)
+        new_line.append(new_tok)
+    return new_line
+
+
+def _is_definition(line: list) -> bool:
+    values = [tok.value for tok in line if not tok.value.isspace()]
+    return values[:1] == ["#"] and values[1:2] in (["define"], ["undef"])
+
+
+def _read_line_chunks(file: TextIO, chunk_size: int) -> Iterator[List[str]]:
+    # lines are split like str.splitlines does it for the whole text
+    chunk = []
+    size = 0
+    for line in file:
+        chunk.extend(line.splitlines() or [""])
+        size += len(line)
+        # a continued line must be lexed together with the next one
+        if size >= chunk_size and not chunk[-1].rstrip().endswith("\\"):
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
 
+
+class PyPreprocessor(Preprocessor):
     def __init__(self, disabled: Optional[bool] = None):
         if disabled is None:
-            disabled = self.default_disabled
+            disabled = not get_config().preprocess_unknown_sources
         super().__init__(disabled=disabled)
         self.included_files = []
+        self.header_macros = {}
+        self.header_cache = header_cache
+        macros = get_config().macros
+        if macros:
+            self.predefine(macros)
+
+    def predefine(self, macros: Tuple[Tuple[str, Optional[str]], ...]):
+        """
+        Defines (name, value) macros, undefining ones with None value
+        """
+        definitions = predefined_cache.get(macros)
+        if definitions is not None:
+            # macro objects are shared like header macros
+            for name, macro in definitions:
+                if macro is None:
+                    self.macros.pop(name, None)
+                else:
+                    self.macros[name] = macro
+            return
+
+        definitions = []
+        for name, value in macros:
+            if value is None:
+                self.macros.pop(name, None)
+                definitions.append((name, None))
+            else:
+                # name can include parameters of function-like macro
+                self.define(f"{name} {value}")
+                name = name.partition("(")[0]
+                definitions.append((name, self.macros[name]))
+        predefined_cache[macros] = definitions
+
+    def parse_file(
+        self, file: TextIO, source: str, chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> None:
+        """
+        Like parse, but reads and tokenizes the file incrementally
+        """
+        if self.enable_trigraphs:
+            return self.parse(file.read(), source)
+        self.ignore = {}
+        self.parser = self.parsegen(
+            _read_line_chunks(file, chunk_size),
+            source,
+            os.path.abspath(source),
+        )
+        self.temp_path.insert(0, os.path.dirname(source))
+
+    def _group_line_chunks(
+        self, chunks: Iterable[List[str]], abssource: Optional[str]
+    ):
+        lex = self.lexer.clone()
+        lineno = 1
+        lines = []
+        chunks = iter(chunks)
+        chunk = next(chunks, None)
+        while chunk is not None:
+            lines.extend(chunk)
+            chunk = next(chunks, None)
+            is_last = chunk is None
+            text = "\n".join([line.rstrip() for line in lines])
+            lex.input(text if is_last else text + "\n")
+            lex.lineno = lineno
+            groups = []
+            current_line = []
+            while True:
+                tok = lex.token()
+                if not tok:
+                    break
+                tok.source = abssource
+                current_line.append(tok)
+                if tok.type in self.t_WS and tok.value == "\n":
+                    groups.append(current_line)
+                    current_line = []
+
+            if is_last:
+                yield from groups
+                # the same as in group_lines
+                if current_line:
+                    nltok = copy(current_line[-1])
+                    nltok.type = self.t_NEWLINE
+                    nltok.value = "\n"
+                    current_line.append(nltok)
+                    yield current_line
+                return
+
+            # lines from the first unterminated string or comment
+            # are tokenized again together with the next chunk
+            if current_line:
+                groups.append(current_line)
+            end = len(groups)
+            for i, line in enumerate(groups):
+                if line is current_line or any(
+                    tok.type in self.t_UNTERMINATED for tok in line
+                ):
+                    end = i
+                    break
+            yield from groups[:end]
+            if end < len(groups):
+                next_lineno = groups[end][0].lineno
+                del lines[: next_lineno - lineno]
+                lineno = next_lineno
+            else:
+                lines.clear()
+                lineno = lex.lineno
+
+    def group_lines(self, input: str, abssource: Optional[str]):
+        if not isinstance(input, str):
+            yield from self._group_line_chunks(input, abssource)
+            return
+        if (
+            abssource is None
+            or os.path.abspath(abssource) not in self.included_files
+        ):
+            yield from super().group_lines(input, abssource)
+            return
+
+        key = (abssource, input)
+        entry = self.header_cache.get(key)
+        profiling.count("header_misses" if entry is None else "header_hits")
+        if entry is None:
+            lines = [
+                (line, _is_definition(line))
+                for line in super().group_lines(input, abssource)
+            ]
+            entry = self.header_cache[key] = lines, {}
+        lines, self.header_macros[abssource] = entry
+
+        for line, is_definition in lines:
+            # other lines' tokens are modified during preprocessing
+            yield line.copy() if is_definition else _copy_line(line)
+
+    def define(self, tokens):
+        if isinstance(tokens, str) or not tokens:
+            return super().define(tokens)
+
+        name = tokens[0]
+        macros = self.header_macros.get(getattr(name, "source", None))
+        if macros is None:
+            return super().define(tokens)
+
+        # definitions don't depend on preprocessor state,
+        # so they can be shared between preprocessors
+        key = name.lineno, "".join(tok.value for tok in tokens)
+        macro = macros.get(key)
+        if macro is None:
+            super().define(tokens)
+            macros[key] = self.macros[name.value]
+        else:
+            self.macros[name.value] = macro
 
     def write(self, file: TextIO):
         macros_backup = self.macros.copy()
@@ -43,10 +257,7 @@ class PyPreprocessor(Preprocessor):
 PreprocessingFunction = Callable[[str, str, PyPreprocessor], str]
 
 
-def _preprocess(src: str, filename: str, preprocessor: PyPreprocessor) -> str:
-    preprocessor.parse(src, filename)
-
-    out = StringIO()
+def _write_preprocessed(preprocessor: PyPreprocessor, out: TextIO) -> None:
     try:
         preprocessor.write(out)
     except SyntaxError:
@@ -63,18 +274,43 @@ def _preprocess(src: str, filename: str, preprocessor: PyPreprocessor) -> str:
             f"preprocessor exit code is not zero: {preprocessor.return_code}"
         )
 
+
+def _preprocess(src: str, filename: str, preprocessor: PyPreprocessor) -> str:
+    preprocessor.parse(src, filename)
+    out = StringIO()
+    _write_preprocessed(preprocessor, out)
     return out.getvalue()
 
 
+def _get_preprocessing_function() -> PreprocessingFunction:
+    return get_config().preprocessing_function or _preprocess
+
+
 def set_preprocessing_function(
     func: PreprocessingFunction,
 ) -> PreprocessingFunction:
-    global _preprocess
+    prev_func = set_default_config(
+        preprocessing_function=func
+    ).preprocessing_function
+
+    return prev_func or _preprocess
+
 
-    prev_func = _preprocess
-    _preprocess = func
+def _create_preprocessor(filename: str) -> PyPreprocessor:
+    return PyPreprocessor(disabled=get_disabled(filename))
 
-    return prev_func
+
+def _apply_precompiled_header(
+    src: str, filename: str, p: PyPreprocessor
+) -> str:
+    config = get_config()
+    if (
+        not config.precompiled_headers
+        or config.preprocessing_function is not None
+        or p.disabled
+    ):
+        return src
+    return apply_precompiled_header(src, filename, p, config.cache_dir)
 
 
 def preprocess(
@@ -84,44 +320,252 @@ def preprocess(
         src = src.read()
 
     if p is None:
-        # always enable preprocessing of ppy files
-        if filename.endswith(tuple(FILE_EXTENSIONS)):
-            disabled = False
-        # but disable other Python files
-        elif filename.endswith(tuple(SOURCE_SUFFIXES)):
-            disabled = True
-        else:
-            disabled = None
-        p = PyPreprocessor(disabled=disabled)
+        p = _create_preprocessor(filename)
+        src = _apply_precompiled_header(src, filename, p)
 
     # indicate that we started preprocessing
     preprocessed_files[filename] = None
 
     # save preprocessed file to display actual SyntaxError
-    result = preprocessed_files[filename] = _preprocess(src, filename, p)
+    result = preprocessed_files[filename] = _get_preprocessing_function()(
+        src, filename, p
+    )
     return result, p.included_files
 
 
+def _preprocess_cached(
+    src: str, filename: str, cache_dir: str
+) -> Tuple[str, list]:
+    cache = PreprocessedCache(cache_dir)
+    p = _create_preprocessor(filename)
+    key = cache.make_key(src, filename, p, _get_preprocessing_function())
+
+    cached = cache.get(key)
+    profiling.count("cache_misses" if cached is None else "cache_hits")
+    if cached is not None:
+        preprocessed_files[filename] = cached[0]
+        return cached
+
+    res, deps = preprocess(
+        _apply_precompiled_header(src, filename, p), filename, p
+    )
+    cache.put(key, res, deps)
+    return res, deps
+
+
 def preprocess_file(
-    filename: str, save_files: bool = False
+    filename: str, save_files: bool = False, cache_dir: Optional[str] = None
 ) -> Tuple[str, list]:
     with open(filename) as f:
-        res, deps = preprocess(f, filename)
+        if cache_dir is None:
+            res, deps = preprocess(f, filename)
+        else:
+            res, deps = _preprocess_cached(f.read(), filename, cache_dir)
     if save_files:
         with open(py_from_ppy_filename(filename), "w") as f:
             f.write(res)
     return res, deps
 
 
+class ChunkWriter:
+    """
+    Text stream which encodes written text in chunks
+    and passes them to sinks instead of keeping it
+    """
+
+    def __init__(
+        self,
+        sinks: Iterable[Callable[[bytes], Any]],
+        chunk_size: int = STREAM_CHUNK_SIZE,
+    ) -> None:
+        self.sinks = list(sinks)
+        self.chunk_size = chunk_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, s: str) -> int:
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self.chunk_size:
+            self.flush()
+        return len(s)
+
+    def flush(self) -> None:
+        if not self._parts:
+            return
+        chunk = "".join(self._parts).encode()
+        self._parts.clear()
+        self._size = 0
+        for sink in self.sinks:
+            sink(chunk)
+
+
+def preprocess_file_streaming(
+    filename: str,
+    save_files: bool = False,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+) -> Tuple[Union[bytes, bytearray], list]:
+    """
+    Preprocesses file in chunks, returning encoded output.
+    Output chunks go to the result, to the .py file
+    and to the on-disk line store, no full-size strings are built.
+    """
+    if get_config().preprocessing_function is not None:
+        # custom preprocessing functions work with whole strings
+        res, deps = preprocess_file(filename, save_files)
+        return res.encode(), deps
+
+    p = _create_preprocessor(filename)
+    result = bytearray()
+    # indicate that we started preprocessing
+    preprocessed_files[filename] = None
+    with ExitStack() as stack:
+        sinks = [result.extend]
+        sinks.append(
+            stack.enter_context(preprocessed_files.open_writer(filename))
+        )
+        if save_files:
+            py_file = stack.enter_context(
+                open(py_from_ppy_filename(filename), "wb")
+            )
+            sinks.append(py_file.write)
+        p.parse_file(stack.enter_context(open(filename)), filename, chunk_size)
+        out = ChunkWriter(sinks, chunk_size)
+        _write_preprocessed(p, out)
+        out.flush()
+    return result, p.included_files
+
+
+def _preprocess_memoized(src: str, filename: str) -> str:
+    config = get_config()
+    key = (
+        hashlib.blake2b(src.encode("utf-8", "surrogatepass")).digest(),
+        filename,
+        config.preprocess_unknown_sources,
+        config.preprocessing_function,
+        config.macros,
+    )
+    entry = string_cache.get(key)
+    if entry is not None:
+        res, hashes = entry
+        if hash_deps(list(hashes)) == hashes:
+            preprocessed_files[filename] = res
+            return res
+
+    res, deps = preprocess(src, filename)
+    string_cache[key] = res, hash_deps(deps)
+    return res
+
+
 def maybe_preprocess(
     src: Any, filename: str, preprocessor: Optional[PyPreprocessor] = None
 ):
+    if (
+        preprocessor is None
+        and isinstance(src, (str, bytes))
+        and not needs_preprocessing(
+            src, filename, not get_config().preprocess_unknown_sources
+        )
+    ):
+        # the output would be the same, so skip all the work
+        return src
     if isinstance(src, bytes):
         src = src.decode()
     if isinstance(src, str):
         # this is essential for interactive mode
         has_newline = src.endswith("\n")
-        src, _ = preprocess(src, filename, preprocessor)
+        if preprocessor is None:
+            src = _preprocess_memoized(src, filename)
+        else:
+            # the preprocessor keeps state between calls, can't memoize
+            src, _ = preprocess(src, filename, preprocessor)
         if not has_newline:
             src = src.rstrip("\n")
     return src
+
+
+class PreprocessResult(NamedTuple):
+    path: str
+    # None if preprocessing failed
+    text: Optional[str]
+    dependencies: Optional[List[str]]
+    elapsed: float
+    error: Optional[BaseException] = None
+
+
+# header caches of worker threads
+_worker_state = threading.local()
+
+
+def _preprocess_isolated(path: str, config: Config) -> PreprocessResult:
+    with configure(**config._asdict()):
+        return _preprocess_file_isolated(path)
+
+
+def _preprocess_file_isolated(path: str) -> PreprocessResult:
+    start = time.perf_counter()
+    try:
+        cache = _worker_state.header_cache
+    except AttributeError:
+        cache = _worker_state.header_cache = LRUCache(header_cache.maxsize)
+    try:
+        with open(path) as f:
+            src = f.read()
+        p = _create_preprocessor(path)
+        p.header_cache = cache
+        src = _apply_precompiled_header(src, path, p)
+        # not preprocess(), preprocessed_files is updated by the caller
+        text = _get_preprocessing_function()(src, path, p)
+    except Exception as e:
+        return PreprocessResult(
+            path, None, None, time.perf_counter() - start, e
+        )
+    return PreprocessResult(
+        path, text, p.included_files, time.perf_counter() - start
+    )
+
+
+def _save_result(result: PreprocessResult) -> PreprocessResult:
+    # None indicates failure, like in preprocess()
+    preprocessed_files[result.path] = result.text
+    return result
+
+
+def preprocess_many(
+    paths: Iterable[str],
+    workers: Optional[int] = None,
+    executor: str = "process",
+) -> Iterator[PreprocessResult]:
+    """
+    Preprocesses files on a process or thread pool,
+    yielding results as they complete.
+    Results are saved for tracebacks like with preprocess_file.
+    """
+    from concurrent.futures import (
+        ProcessPoolExecutor,
+        ThreadPoolExecutor,
+        as_completed,
+    )
+
+    try:
+        executor_class = {
+            "process": ProcessPoolExecutor,
+            "thread": ThreadPoolExecutor,
+        }[executor]
+    except KeyError:
+        raise ValueError(f"unknown executor: {executor!r}") from None
+
+    paths = list(paths)
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            yield _save_result(_preprocess_file_isolated(path))
+        return
+
+    # workers don't share context with this thread
+    config = get_config()
+    with executor_class(workers) as pool:
+        futures = [
+            pool.submit(_preprocess_isolated, path, config) for path in paths
+        ]
+        for future in as_completed(futures):
+            yield _save_result(future.result())
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import os
+import sys
+import time
+import atexit
+import threading
+from contextlib import contextmanager, nullcontext
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Dict, Iterator, List, Optional, TextIO
+
+
+PROFILE_ENV = "PWCP_PROFILE_IMPORTS"
+FORMATS = ("table", "json")
+STAGES = ("find_spec", "read_pyc", "validate", "preprocess", "compile")
+
+enabled = False
+output_format = "table"
+# module name -> stage or counter name -> seconds or count
+records: Dict[str, Dict[str, float]] = {}
+_records_lock = threading.Lock()
+# stacks of modules being imported, per thread
+_local = threading.local()
+_null_context = nullcontext()
+
+
+def _get_current() -> List[str]:
+    try:
+        return _local.current
+    except AttributeError:
+        current = _local.current = []
+        return current
+
+
+def _add(key: str, name: str, value: float) -> None:
+    with _records_lock:
+        record = records.setdefault(key, {})
+        record[name] = record.get(name, 0) + value
+
+
+def enable(fmt: str = "table") -> None:
+    """
+    Starts recording import statistics and dumps them to stderr at exit
+    """
+    global enabled, output_format
+
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown profile format: {fmt!r}")
+    output_format = fmt
+    if not enabled:
+        enabled = True
+        atexit.register(dump)
+
+
+@contextmanager
+def _stage(key: str, name: str) -> Iterator[None]:
+    current = _get_current()
+    current.append(key)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        current.pop()
+        _add(key, name, elapsed)
+
+
+def stage(key: str, name: str):
+    """
+    Context manager measuring time of a stage of importing a module
+    """
+    if not enabled:
+        return _null_context
+    return _stage(key, name)
+
+
+def count(name: str, n: int = 1, key: Optional[str] = None) -> None:
+    """
+    Increments a counter of the given module or of the one being imported
+    """
+    if not enabled:
+        return
+    if key is None:
+        current = _get_current()
+        if not current:
+            return
+        key = current[-1]
+    _add(key, name, n)
+
+
+def _total(record: Dict[str, float]) -> float:
+    return sum(record.get(name, 0) for name in STAGES)
+
+
+def dump(file: Optional[TextIO] = None) -> None:
+    if file is None:
+        file = sys.stderr
+    ordered = sorted(
+        records.items(), key=lambda item: _total(item[1]), reverse=True
+    )
+
+    if output_format == "json":
+        import json
+
+        json.dump(
+            {
+                key: {"total": _total(record), **record}
+                for key, record in ordered
+            },
+            file,
+            indent=2,
+        )
+        file.write("\n")
+        return
+
+    counters = sorted(
+        {name for _, record in ordered for name in record} - set(STAGES)
+    )
+    columns = [*STAGES, "total"]
+    header = [f"{name + ' ms':>14}" for name in columns]
+    header.extend(f"{name:>14}" for name in counters)
+    print("pwcp import profile:", *header, "module", file=file)
+    for key, record in ordered:
+        row = [f"{record.get(name, 0) * 1000:14.2f}" for name in STAGES]
+        row.append(f"{_total(record) * 1000:14.2f}")
+        row.extend(f"{record.get(name, 0):>14}" for name in counters)
+        print("pwcp import profile:", *row, key, file=file)
+
+
+if os.environ.get(PROFILE_ENV):
+    env_format = os.environ[PROFILE_ENV]
+    enable(env_format if env_format in FORMATS else "table")
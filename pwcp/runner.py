@@ -1,56 +1,153 @@
+from __future__ import annotations
+
 import os
 import sys
-import argparse
-from typing import Iterable
-from functools import partial
+from functools import lru_cache, partial
 from importlib import util
 from importlib.machinery import SourceFileLoader
 
-from . import hooks
+from . import hooks, profiling
 from .config import FILE_EXTENSIONS
 from .version import __version__
 from .utils import create_exception_handler, is_package
 
+# argparse is slow to import, so parsers are created on first use
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Iterable, List, Optional, Tuple
+    import argparse
+
+
+def _get_prog() -> str:
+    # with python -m, sys.argv[0] is "-m" while the package is imported
+    # and path of __main__.py after that
+    if sys.argv[0] == "-m" or os.path.basename(sys.argv[0]) == "__main__.py":
+        return "python -m " + __package__
+    return os.path.basename(sys.argv[0])
+
+
+def _parse_definition(definition: str) -> Tuple[str, str]:
+    # like in C compilers, -D NAME defines it as 1
+    name, sep, value = definition.partition("=")
+    return name, value if sep else "1"
+
+
+def _parse_undefinition(name: str) -> Tuple[str, None]:
+    return name, None
+
+
+def _add_macro_arguments(parser: "argparse.ArgumentParser") -> None:
+    parser.add_argument(
+        "-D",
+        dest="macros",
+        action="append",
+        type=_parse_definition,
+        default=[],
+        metavar="NAME[=VALUE]",
+        help="define macro for all files (can be specified multiple times)",
+    )
+    parser.add_argument(
+        "-U",
+        dest="macros",
+        action="append",
+        type=_parse_undefinition,
+        metavar="NAME",
+        help="undefine macro for all files (can be specified multiple times)",
+    )
+
+
+def _add_compact_argument(parser: "argparse.ArgumentParser") -> None:
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="fold constant conditions left by conditional compilation"
+        " and keep preprocessed sources without empty lines",
+    )
+
 
-parser = argparse.ArgumentParser(
-    (
-        "python -m " + __package__
-        if sys.argv[0] == "-m"
-        else os.path.basename(sys.argv[0])
-    ),
-    description="Python with C preprocessor",
-)
-parser.add_argument(
-    "--version", action="version", version="pwcp " + __version__
-)
-parser.add_argument("-m", action="store_true", help="run target as module")
-parser.add_argument(
-    "-c", action="store_true", help="run target as command line"
-)
-parser.add_argument(
-    "--PP",
-    "--prefer-py",
-    dest="prefer_python",
-    action="store_true",
-    help="prefer .py files over .ppy when importing",
-)
-parser.add_argument(
-    "--SF",
-    "--save-files",
-    dest="save_files",
-    action="store_true",
-    help="save .ppy files to .py after preprocessing",
-)
-parser.add_argument(
-    "--PUS",
-    "--preprocess-unknown-sources",
-    dest="preprocess_unknown_sources",
-    action="store_true",
-    help="preprocess code even if filename is unknown"
-    " (for example, in exec call)",
-)
-parser.add_argument("target")
-parser.add_argument("args", nargs=argparse.REMAINDER)
+def _create_parser(prog: str) -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog, description="Python with C preprocessor"
+    )
+    parser.add_argument(
+        "--version", action="version", version="pwcp " + __version__
+    )
+    parser.add_argument("-m", action="store_true", help="run target as module")
+    parser.add_argument(
+        "-c", action="store_true", help="run target as command line"
+    )
+    parser.add_argument(
+        "--PP",
+        "--prefer-py",
+        dest="prefer_python",
+        action="store_true",
+        help="prefer .py files over .ppy when importing",
+    )
+    parser.add_argument(
+        "--SF",
+        "--save-files",
+        dest="save_files",
+        action="store_true",
+        help="save .ppy files to .py after preprocessing",
+    )
+    parser.add_argument(
+        "--PUS",
+        "--preprocess-unknown-sources",
+        dest="preprocess_unknown_sources",
+        action="store_true",
+        help="preprocess code even if filename is unknown"
+        " (for example, in exec call)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("PWCP_CACHE_DIR"),
+        help="directory for caching preprocessed files between runs"
+        " (defaults to PWCP_CACHE_DIR environment variable)",
+    )
+    parser.add_argument(
+        "--daemon",
+        default=os.environ.get("PWCP_DAEMON"),
+        help="socket of pwcp serve daemon to preprocess imported files with"
+        " (defaults to PWCP_DAEMON environment variable)",
+    )
+    parser.add_argument(
+        "--PCH",
+        "--precompiled-headers",
+        dest="precompiled_headers",
+        action="store_true",
+        help="reuse macros of leading #include and #define lines"
+        " shared by modules (stored in cache directory if it's set)",
+    )
+    parser.add_argument(
+        "--stream",
+        dest="stream_chunk_size",
+        type=int,
+        metavar="CHUNK_SIZE",
+        help="preprocess imported files in chunks of about CHUNK_SIZE"
+        " characters instead of keeping whole output in memory"
+        " (for very large generated files, can't be used with"
+        " a cache directory or --PCH)",
+    )
+    _add_compact_argument(parser)
+    parser.add_argument(
+        "--profile-imports",
+        action="store_true",
+        help="print time spent in each stage of importing every module"
+        " at exit (can also be enabled with PWCP_PROFILE_IMPORTS"
+        " environment variable)",
+    )
+    parser.add_argument(
+        "--profile-format",
+        choices=profiling.FORMATS,
+        default="table",
+        help="output format of --profile-imports",
+    )
+    _add_macro_arguments(parser)
+    parser.add_argument("target")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    return parser
 
 
 def main_with_params(
@@ -62,11 +159,27 @@ def main_with_params(
     prefer_python: bool,
     save_files: bool,
     preprocess_unknown_sources: bool,
+    cache_dir: Optional[str] = None,
+    daemon: Optional[str] = None,
+    stream_chunk_size: Optional[int] = None,
+    precompiled_headers: bool = False,
+    macros: Iterable[Tuple[str, Optional[str]]] = (),
+    compact: bool = False,
+    profile_imports: bool = False,
+    profile_format: str = "table",
 ):
+    if profile_imports:
+        profiling.enable(profile_format)
     hooks.install(
         prefer_python=prefer_python,
         save_files=save_files,
         preprocess_unknown_sources=preprocess_unknown_sources,
+        cache_dir=cache_dir,
+        daemon=daemon,
+        stream_chunk_size=stream_chunk_size,
+        precompiled_headers=precompiled_headers,
+        macros=macros,
+        compact=compact,
     )
     if not m:
         filename: str
@@ -112,9 +225,339 @@ def main_with_params(
     del sys.path[0]
 
 
+def _add_compile_arguments(
+    command_parser: "argparse.ArgumentParser",
+) -> None:
+    from py_compile import PycInvalidationMode
+
+    command_parser.add_argument(
+        "paths", nargs="+", help="files and directories to compile"
+    )
+    command_parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=0,
+        help="number of worker processes (0 means number of CPUs)",
+    )
+    command_parser.add_argument(
+        "--invalidation-mode",
+        choices=[
+            mode.name.lower().replace("_", "-") for mode in PycInvalidationMode
+        ],
+        default="timestamp",
+        help="how to check whether the bytecode is up to date",
+    )
+    command_parser.add_argument(
+        "-q", "--quiet", action="store_true", help="only print errors"
+    )
+    command_parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("PWCP_CACHE_DIR"),
+        help="directory for caching preprocessed files and dependency graph"
+        " between runs (defaults to PWCP_CACHE_DIR environment variable)",
+    )
+    _add_macro_arguments(command_parser)
+    _add_compact_argument(command_parser)
+
+
+def _create_compileall_parser(prog: str) -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog, description="Preprocess and compile .ppy files to bytecode"
+    )
+    _add_compile_arguments(parser)
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="compile even if bytecode is up to date",
+    )
+    return parser
+
+
+def _create_build_parser(prog: str) -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog,
+        description="Preprocess and compile .ppy files which changed"
+        " or include changed files since the last build",
+    )
+    _add_compile_arguments(parser)
+    return parser
+
+
+def _compile(args: "argparse.Namespace", paths: Iterable[str], force: bool):
+    from py_compile import PycInvalidationMode
+
+    from .compileall import compile_files
+    from .depgraph import get_dependency_graph
+
+    invalidation_mode = PycInvalidationMode[
+        args.invalidation_mode.upper().replace("-", "_")
+    ]
+    failed = False
+    for result in compile_files(
+        paths,
+        args.workers or None,
+        invalidation_mode,
+        force,
+        args.cache_dir,
+        tuple(args.macros),
+        args.compact,
+    ):
+        if result.status == "failed":
+            failed = True
+            print(
+                f"Error compiling {result.path}: {result.error!r}",
+                file=sys.stderr,
+            )
+        elif not args.quiet:
+            print(
+                f"{result.status:<10} {result.elapsed * 1000:8.1f} ms"
+                f" {result.path}"
+            )
+    if args.cache_dir is not None:
+        get_dependency_graph(args.cache_dir, tuple(args.macros)).save()
+    return int(failed)
+
+
+def compileall_main(args: Iterable[str]) -> int:
+    args = get_parser("compileall").parse_args(args)
+
+    from .compileall import find_files
+
+    return _compile(args, find_files(args.paths), args.force)
+
+
+def build_main(args: Iterable[str]) -> int:
+    args = get_parser("build").parse_args(args)
+    if args.cache_dir is None:
+        get_parser("build").error(
+            "cache directory is required for storing the dependency graph"
+        )
+
+    from .context import configure
+    from .compileall import find_files
+    from .depgraph import get_dependency_graph
+
+    files = list(find_files(args.paths))
+    macros = tuple(args.macros)
+    # pycs of other macros are in other files
+    with configure(macros=macros):
+        outdated = get_dependency_graph(args.cache_dir, macros).find_outdated(
+            files
+        )
+    if not args.quiet:
+        print(f"{len(outdated)} of {len(files)} modules need rebuilding")
+    return _compile(args, outdated, True)
+
+
+def _create_bench_parser(prog: str) -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog,
+        description="Measure preprocessing and import overhead"
+        " on a generated tree of .ppy files",
+    )
+    for name, default in zip(
+        ("modules", "headers", "fanout", "macros", "depth"),
+        (50, 10, 3, 50, 3),
+    ):
+        parser.add_argument("--" + name, type=int, default=default)
+    parser.add_argument(
+        "--scenario",
+        dest="scenarios",
+        action="append",
+        help="scenario to run (can be specified multiple times, default: all)",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="runs of each scenario"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="save results to JSON file for later comparison",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="compare two saved results instead of running benchmarks",
+    )
+    return parser
+
+
+def bench_main(args: Iterable[str]) -> int:
+    args = get_parser("bench").parse_args(args)
+
+    from . import benchmark
+
+    if args.compare:
+        benchmark.compare(*args.compare, file=sys.stdout)
+        return 0
+    if args.scenarios:
+        unknown = set(args.scenarios) - set(benchmark.SCENARIOS)
+        if unknown:
+            get_parser("bench").error(
+                "unknown scenarios: " + ", ".join(sorted(unknown))
+            )
+    params = benchmark.TreeParams(
+        args.modules, args.headers, args.fanout, args.macros, args.depth
+    )
+    data = benchmark.run(params, args.scenarios, args.repeat, sys.stdout)
+    if args.output:
+        benchmark.save(data, args.output)
+    return 0
+
+
+def _create_bundle_parser(prog: str) -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog,
+        description="Pack preprocessed and compiled .ppy files"
+        " and .py files of directories into importable zip archive",
+    )
+    parser.add_argument("paths", nargs="+", metavar="directory")
+    parser.add_argument(
+        "-o", "--output", required=True, help="path of the archive"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="only print errors"
+    )
+    _add_macro_arguments(parser)
+    _add_compact_argument(parser)
+    return parser
+
+
+def bundle_main(args: Iterable[str]) -> int:
+    args = get_parser("bundle").parse_args(args)
+
+    from .bundle import create_bundle
+    from .context import configure
+
+    with configure(macros=tuple(args.macros), compact=args.compact):
+        try:
+            modules = create_bundle(args.output, args.paths)
+        except Exception as e:
+            print(f"Error creating bundle: {e!r}", file=sys.stderr)
+            return 1
+    if not args.quiet:
+        print(f"{len(modules)} modules bundled to {args.output}")
+    return 0
+
+
+def _create_serve_parser(prog: str) -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog,
+        description="Keep preprocessor and compiled code warm"
+        " and serve them to other pwcp processes over Unix socket",
+    )
+    parser.add_argument(
+        "socket",
+        nargs="?",
+        default=os.environ.get("PWCP_DAEMON"),
+        help="path of the socket"
+        " (defaults to PWCP_DAEMON environment variable)",
+    )
+    return parser
+
+
+def serve_main(args: Iterable[str]) -> int:
+    args = get_parser("serve").parse_args(args)
+    if args.socket is None:
+        get_parser("serve").error("socket path is required")
+
+    from .daemon import serve
+
+    serve(args.socket)
+    return 0
+
+
+COMMANDS = {
+    "compileall": compileall_main,
+    "build": build_main,
+    "bench": bench_main,
+    "bundle": bundle_main,
+    "serve": serve_main,
+}
+
+
+PARSER_FACTORIES = {
+    None: _create_parser,
+    "compileall": _create_compileall_parser,
+    "build": _create_build_parser,
+    "bench": _create_bench_parser,
+    "bundle": _create_bundle_parser,
+    "serve": _create_serve_parser,
+}
+
+
+@lru_cache(maxsize=None)
+def get_parser(command: Optional[str] = None) -> "argparse.ArgumentParser":
+    """
+    Returns parser of the main command line or of a command
+    """
+    prog = _get_prog()
+    if command is not None:
+        prog += " " + command
+    return PARSER_FACTORIES[command](prog)
+
+
+def __getattr__(name: str):
+    # parser, compileall_parser, build_parser, etc.
+    command = name[: -len("_parser")] if name.endswith("_parser") else None
+    if name == "parser" or command in COMMANDS:
+        return get_parser(command)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _parse_plain_args(args: List[str]) -> Optional[dict]:
+    """
+    Returns parameters for running a file without options,
+    which is common enough to skip importing argparse
+    """
+    if not args or args[0].startswith("-"):
+        return None
+    return {
+        "target": args[0],
+        "args": args[1:],
+        "m": False,
+        "c": False,
+        "prefer_python": False,
+        "save_files": False,
+        "preprocess_unknown_sources": False,
+        "cache_dir": os.environ.get("PWCP_CACHE_DIR"),
+        "daemon": os.environ.get("PWCP_DAEMON"),
+    }
+
+
+def _check_stream_params(params: dict) -> None:
+    # streamed output isn't kept whole, which both of them need
+    if params["cache_dir"] is not None:
+        get_parser().error(
+            "--stream can't be used with a cache directory"
+            " (--cache-dir or PWCP_CACHE_DIR)"
+        )
+    if params["precompiled_headers"]:
+        get_parser().error("--stream can't be used with --PCH")
+
+
 def main(args=sys.argv[1:]):
-    args = parser.parse_args(args)
-    main_with_params(**vars(args))
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args[1:])
+    params = _parse_plain_args(args)
+    if params is None:
+        params = vars(get_parser().parse_args(args))
+        if params["stream_chunk_size"] is not None:
+            _check_stream_params(params)
+    main_with_params(**params)
 
 
 if __name__ == "__main__":
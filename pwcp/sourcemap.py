@@ -0,0 +1,122 @@
+"""
+Source maps: lines of preprocessed sources are mapped to files
+and lines they came from using #line directives in them
+"""
+
+from __future__ import annotations
+
+import re
+from bisect import bisect_right
+from collections import namedtuple
+
+from .store import preprocessed_files
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Dict, Optional, Union
+
+
+LINE_DIRECTIVE = re.compile(r'^#line (\d+)(?: "(.*)")?[ \t]*\r?$', re.M)
+LINE_DIRECTIVE_BYTES = re.compile(LINE_DIRECTIVE.pattern.encode(), re.M)
+
+
+SourceLocation = namedtuple("SourceLocation", ("filename", "lineno"))
+
+
+class SourceMap(
+    namedtuple("SourceMap", ("files", "starts", "file_indexes", "lines"))
+):
+    """
+    Maps lines of preprocessed source to the original files.
+    Lines from `starts[i]` to the next start come from
+    `files[file_indexes[i]]`, starting at `lines[i]`.
+    Lines of #line directives belong to the previous range,
+    they have no code.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_source(
+        cls, source: Union[str, bytes, bytearray], filename: str
+    ) -> "SourceMap":
+        if isinstance(source, str):
+            pattern, newline = LINE_DIRECTIVE, "\n"
+        else:
+            pattern, newline = LINE_DIRECTIVE_BYTES, b"\n"
+        files = [filename]
+        indexes = {filename: 0}
+        starts = [1]
+        file_indexes = [0]
+        lines = [1]
+        lineno = 1
+        pos = 0
+        for match in pattern.finditer(source):
+            lineno += source.count(newline, pos, match.start())
+            pos = match.start()
+            name = match.group(2)
+            if name is None:
+                index = file_indexes[-1]
+            else:
+                if isinstance(name, bytes):
+                    name = name.decode("utf-8", "surrogateescape")
+                index = indexes.get(name)
+                if index is None:
+                    index = indexes[name] = len(files)
+                    files.append(name)
+            if starts[-1] == lineno + 1:
+                # the previous directive is overridden
+                del starts[-1], file_indexes[-1], lines[-1]
+            starts.append(lineno + 1)
+            file_indexes.append(index)
+            lines.append(int(match.group(1)))
+        return cls(
+            tuple(files), tuple(starts), tuple(file_indexes), tuple(lines)
+        )
+
+    def lookup(self, lineno: int) -> SourceLocation:
+        """
+        Returns file and line the line of preprocessed source came from
+        """
+        i = max(bisect_right(self.starts, lineno) - 1, 0)
+        return SourceLocation(
+            self.files[self.file_indexes[i]],
+            self.lines[i] + lineno - self.starts[i],
+        )
+
+
+# file name -> source map of its preprocessed source,
+# set when the module is preprocessed or loaded from pyc
+_source_maps: Dict[str, SourceMap] = {}
+
+
+def set_source_map(filename: str, source_map: SourceMap) -> None:
+    _source_maps[filename] = source_map
+
+
+def get_source_map(filename: str) -> Optional[SourceMap]:
+    """
+    Returns source map of the preprocessed file,
+    None if the file wasn't preprocessed
+    """
+    source_map = _source_maps.get(filename)
+    if source_map is not None:
+        return source_map
+    # for example, source passed to exec, it can change, so it isn't saved
+    if filename in preprocessed_files:
+        text = preprocessed_files[filename]
+        if text is not None:
+            return SourceMap.from_source(text, filename)
+    return None
+
+
+def map_location(filename: str, lineno: int) -> SourceLocation:
+    """
+    Returns location the line of preprocessed file came from,
+    the same location if the file wasn't preprocessed.
+    Intended for profilers and coverage tools.
+    """
+    source_map = get_source_map(filename)
+    if source_map is None:
+        return SourceLocation(filename, lineno)
+    return source_map.lookup(lineno)
@@ -0,0 +1,441 @@
+from __future__ import annotations
+
+import os
+import sys
+import zlib
+import atexit
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from collections import OrderedDict
+from collections.abc import MutableMapping, Sequence
+from contextlib import contextmanager
+
+from .utils import write_atomic
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Callable, Dict, Iterator, List, Optional, Union
+
+
+DEFAULT_BUDGET = 64 * 1024 * 1024
+# line index files store offsets in native byte order
+LINE_INDEX_MAGIC = b"PWCPLIN" + (b"<" if sys.byteorder == "little" else b">")
+# the same, but lines are mapped to lines of the full source
+LINE_MAP_MAGIC = b"PWCPMAP" + LINE_INDEX_MAGIC[-1:]
+LINE_INDEX_HEADER = struct.Struct("=8sQ")
+LINE_INDEX_SUFFIX = ".lines"
+
+
+def _line_offsets(text: Union[str, bytes]) -> array:
+    # offsets of line starts and of the end of the last line
+    offsets = array("Q", [0])
+    offsets.extend(
+        accumulate(
+            len(line) + 1
+            for line in text.split("\n" if isinstance(text, str) else b"\n")
+        )
+    )
+    # the last line has no separator
+    offsets[-1] -= 1
+    if len(offsets) > 1 and offsets[-1] == offsets[-2]:
+        offsets.pop()
+    return offsets
+
+
+class IndexedSource(Sequence):
+    """
+    Lines of a source (without line endings, like str.splitlines),
+    found by their offsets without splitting the text on every lookup.
+    The text can be a string or UTF-8 encoded memory-mapped file.
+    If the text is compacted, line map holds indexes of its lines
+    in the full source and number of lines in it,
+    omitted lines are empty.
+    """
+
+    def __init__(
+        self,
+        text: Union[str, memoryview],
+        offsets: Union[array, memoryview, None] = None,
+        line_map: Union[array, memoryview, None] = None,
+    ) -> None:
+        self._text = text
+        self._offsets = _line_offsets(text) if offsets is None else offsets
+        self._line_map = line_map
+        # mapped file of from_file
+        self._mapping = None
+
+    @classmethod
+    def from_file(cls, path: str) -> Optional["IndexedSource"]:
+        """
+        Maps line index file written by write_line_index,
+        returns None if it's missing or invalid.
+        The mapping keeps the file open until `close` is called.
+        """
+        import mmap
+
+        try:
+            with open(path, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        lines = None
+        buffer = memoryview(mapping)
+        try:
+            lines = cls._from_buffer(buffer)
+        finally:
+            buffer.release()
+            if lines is None:
+                mapping.close()
+        if lines is not None:
+            lines._mapping = mapping
+        return lines
+
+    @classmethod
+    def _from_buffer(cls, buffer: memoryview) -> Optional["IndexedSource"]:
+        size = LINE_INDEX_HEADER.size
+        if len(buffer) < size:
+            return None
+        magic, count = LINE_INDEX_HEADER.unpack(buffer[:size])
+        if magic not in (LINE_INDEX_MAGIC, LINE_MAP_MAGIC):
+            return None
+        # offsets and line map have the same length
+        arrays = []
+        for _ in range(1 if magic == LINE_INDEX_MAGIC else 2):
+            end = size + (count + 1) * 8
+            if len(buffer) < end:
+                return None
+            arrays.append(buffer[size:end].cast("Q"))
+            size = end
+        offsets = arrays[0]
+        line_map = arrays[1] if len(arrays) == 2 else None
+        if offsets[count] != len(buffer) - end:
+            return None
+        return cls(buffer[end:], offsets, line_map)
+
+    def close(self) -> None:
+        """
+        Unmaps the file mapped by from_file,
+        lines can't be looked up after that
+        """
+        mapping, self._mapping = self._mapping, None
+        if mapping is None:
+            return
+        for view in (self._text, self._offsets, self._line_map):
+            if isinstance(view, memoryview):
+                view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            # lines are still exported somewhere, the mapping is closed
+            # when they are collected
+            pass
+
+    def __len__(self) -> int:
+        if self._line_map is not None:
+            return self._line_map[-1]
+        return len(self._offsets) - 1
+
+    def _get_line(self, index: int) -> str:
+        line = self._text[self._offsets[index] : self._offsets[index + 1]]
+        if not isinstance(line, str):
+            line = str(line, "utf-8", "surrogatepass")
+        return line[:-1] if line.endswith("\n") else line
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        if self._line_map is None:
+            return self._get_line(index)
+        count = len(self._offsets) - 1
+        pos = bisect_left(self._line_map, index, 0, count)
+        if pos == count or self._line_map[pos] != index:
+            return ""
+        return self._get_line(pos)
+
+    @property
+    def text(self) -> str:
+        if self._line_map is not None:
+            lines = [""] * len(self)
+            for pos in range(len(self._offsets) - 1):
+                lines[self._line_map[pos]] = self._get_line(pos)
+            return "".join(line + "\n" for line in lines)
+        if isinstance(self._text, str):
+            return self._text
+        return str(self._text, "utf-8", "surrogatepass")
+
+
+def get_line_index_path(pyc_path: str) -> str:
+    return os.path.splitext(pyc_path)[0] + LINE_INDEX_SUFFIX
+
+
+def write_line_index(
+    path: str, data: bytes, line_map: Optional[array] = None
+) -> None:
+    """
+    Writes UTF-8 encoded source with offsets of its lines
+    (and line map of compacted source, see IndexedSource),
+    so IndexedSource.from_file can map it without reading
+    """
+    offsets = _line_offsets(data)
+    if line_map is None:
+        magic = LINE_INDEX_MAGIC
+        chunks = [offsets.tobytes()]
+    else:
+        magic = LINE_MAP_MAGIC
+        chunks = [offsets.tobytes(), line_map.tobytes()]
+    write_atomic(
+        path,
+        LINE_INDEX_HEADER.pack(magic, len(offsets) - 1),
+        *chunks,
+        data,
+    )
+
+
+class LineStore(MutableMapping):
+    """
+    Keeps preprocessed sources for displaying them in tracebacks.
+    When they take more memory than the budget, least recently used
+    sources are evicted and restored on demand.
+    Override `spill`, `restore` and `discard` to change where evicted
+    sources go; by default they are compressed to a temporary directory
+    (`open_writer` writes streamed sources in the same format).
+    Sources can also be backed by line index files, which are mapped
+    only when their lines are needed, or by already indexed lines
+    (see `set_lines`); these don't count towards the budget.
+    Mapped line index files stay open, so at most `max_mapped_files`
+    of them are kept, least recently used are unmapped.
+    All operations are serialized, so it can be shared between threads.
+    """
+
+    max_mapped_files = 64
+
+    def __init__(self, budget: int = DEFAULT_BUDGET) -> None:
+        self.budget = budget
+        self.size = 0
+        self._data = OrderedDict()
+        self._spilled = {}
+        self._spill_dir = None
+        self._spill_counter = 0
+        # sources backed by line index files
+        self._index_files: Dict[str, str] = {}
+        # sources set as indexed lines
+        self._sources: Dict[str, IndexedSource] = {}
+        # lines of sources which were looked up
+        self._indexes: Dict[str, Optional[IndexedSource]] = {}
+        # lines of line index files which were looked up
+        self._mapped: OrderedDict[str, IndexedSource] = OrderedDict()
+        # reentrant because setting a key deletes the old value
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _sizeof(value: Optional[str]) -> int:
+        # sys.getsizeof isn't available on PyPy,
+        # non-ASCII characters are counted at their maximum width
+        if value is None:
+            return 0
+        return len(value) if value.isascii() else len(value) * 4
+
+    def __len__(self) -> int:
+        with self._lock:
+            return (
+                len(self._data)
+                + len(self._spilled)
+                + len(self._index_files)
+                + len(self._sources)
+            )
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            keys = [
+                *self._data,
+                *self._spilled,
+                *self._index_files,
+                *self._sources,
+            ]
+        yield from keys
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return (
+                key in self._data
+                or key in self._spilled
+                or key in self._index_files
+                or key in self._sources
+            )
+
+    def __getitem__(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._index_files or key in self._sources:
+                lines = self.get_lines(key)
+                return None if lines is None else lines.text
+            try:
+                value = self._data[key]
+            except KeyError:
+                pass
+            else:
+                self._data.move_to_end(key)
+                return value
+
+            token = self._spilled.pop(key)
+            value = self.restore(key, token)
+            self.discard(key, token)
+            self._insert(key, value)
+            return value
+
+    def __setitem__(self, key: str, value: Optional[str]) -> None:
+        with self._lock:
+            if key in self:
+                del self[key]
+            self._insert(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            self._drop_index(key)
+            if key in self._data:
+                self.size -= self._sizeof(self._data.pop(key))
+            elif key in self._index_files:
+                del self._index_files[key]
+            elif key in self._sources:
+                del self._sources[key]
+            else:
+                self.discard(key, self._spilled.pop(key))
+
+    def get_lines(self, key: str) -> Optional[Sequence]:
+        """
+        Returns lines of the source, None if its preprocessing failed.
+        They are indexed once, so looking up a line doesn't split the text.
+        """
+        with self._lock:
+            try:
+                return self._indexes[key]
+            except KeyError:
+                pass
+            lines = self._sources.get(key)
+            if lines is not None:
+                return lines
+            lines = self._mapped.get(key)
+            if lines is not None:
+                self._mapped.move_to_end(key)
+                return lines
+            path = self._index_files.get(key)
+            if path is not None:
+                lines = IndexedSource.from_file(path)
+                if lines is not None:
+                    self._mapped[key] = lines
+                    while len(self._mapped) > self.max_mapped_files:
+                        self._mapped.popitem(last=False)[1].close()
+                    return lines
+            else:
+                text = self[key]
+                lines = None if text is None else IndexedSource(text)
+            self._indexes[key] = lines
+            return lines
+
+    def _drop_index(self, key: str) -> None:
+        self._indexes.pop(key, None)
+        lines = self._mapped.pop(key, None)
+        if lines is not None:
+            lines.close()
+
+    def set_index_file(self, key: str, path: str) -> None:
+        """
+        Sets source of the key to the line index file
+        """
+        with self._lock:
+            if key in self:
+                del self[key]
+            self._index_files[key] = path
+
+    def set_lines(self, key: str, lines: IndexedSource) -> None:
+        """
+        Sets source of the key to the indexed lines
+        """
+        with self._lock:
+            if key in self:
+                del self[key]
+            self._sources[key] = lines
+
+    def _insert(self, key: str, value: Optional[str]) -> None:
+        self._data[key] = value
+        self.size += self._sizeof(value)
+        # the newest entry always stays, it's most likely to be needed
+        while self.size > self.budget and len(self._data) > 1:
+            old_key, old_value = self._data.popitem(last=False)
+            self.size -= self._sizeof(old_value)
+            # the index would keep the text in memory
+            self._indexes.pop(old_key, None)
+            if old_value is None:
+                # nothing to save, failures are cheap to keep
+                self._spilled[old_key] = None
+            else:
+                self._spilled[old_key] = self.spill(old_key, old_value)
+
+    def _get_spill_dir(self) -> str:
+        if self._spill_dir is None:
+            import shutil
+            import tempfile
+
+            self._spill_dir = tempfile.mkdtemp(prefix="pwcp-")
+            atexit.register(shutil.rmtree, self._spill_dir, True)
+        return self._spill_dir
+
+    def _new_spill_path(self) -> str:
+        with self._lock:
+            self._spill_counter += 1
+            return os.path.join(
+                self._get_spill_dir(), str(self._spill_counter)
+            )
+
+    @contextmanager
+    def open_writer(self, key: str) -> Iterator[Callable[[bytes], None]]:
+        """
+        Writes UTF-8 encoded source of the key in chunks
+        directly to the spill directory, so it's never kept in memory.
+        The source is stored only if the block finishes without errors.
+        """
+        path = self._new_spill_path()
+        compressor = zlib.compressobj()
+        try:
+            with open(path, "wb") as f:
+
+                def write(data: bytes) -> None:
+                    f.write(compressor.compress(data))
+
+                yield write
+                f.write(compressor.flush())
+        except BaseException:
+            self.discard(key, path)
+            raise
+        with self._lock:
+            if key in self:
+                del self[key]
+            self._spilled[key] = path
+
+    def spill(self, key: str, value: str) -> object:
+        path = self._new_spill_path()
+        with open(path, "wb") as f:
+            f.write(zlib.compress(value.encode("utf-8", "surrogatepass")))
+        return path
+
+    def restore(self, key: str, token: object) -> Optional[str]:
+        if token is None:
+            return None
+        with open(token, "rb") as f:
+            return zlib.decompress(f.read()).decode("utf-8", "surrogatepass")
+
+    def discard(self, key: str, token: object) -> None:
+        if token is not None:
+            try:
+                os.remove(token)
+            except OSError:
+                pass
+
+
+preprocessed_files = LineStore()
@@ -1,13 +1,27 @@
+from __future__ import annotations
+
 import os
 import sys
+import time
+import marshal
 import warnings
-from typing import Callable, Optional, Type
-from traceback import print_exception
+import threading
+from collections import OrderedDict
+from _imp import source_hash
 from types import ModuleType, TracebackType
-from importlib.machinery import all_suffixes
+from importlib import _bootstrap_external
+from importlib.machinery import SOURCE_SUFFIXES, all_suffixes
 
+from .config import FILE_EXTENSIONS
 from .errors import PreprocessorError
 
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Any, Callable, Hashable, Optional, Type, Union
+
+
+RAW_MAGIC_NUMBER = int.from_bytes(_bootstrap_external.MAGIC_NUMBER, "little")
+
 
 def create_exception_handler(module: Optional[ModuleType]) -> Callable:
     def handle_exc(
@@ -15,12 +29,15 @@ def create_exception_handler(module: Optional[ModuleType]) -> Callable:
         e: BaseException,
         tb: Optional[TracebackType],
     ):
-        from .monkeypatch import preprocessed_files
+        from traceback import print_exception
 
-        if isinstance(e, SyntaxError) and preprocessed_files.get(e.filename):
-            # replace raw text from file with actual code
-            data = preprocessed_files[e.filename]
-            e.text = data.splitlines()[e.lineno - 1]
+        from .store import preprocessed_files
+
+        if isinstance(e, SyntaxError) and e.filename in preprocessed_files:
+            lines = preprocessed_files.get_lines(e.filename)
+            if lines and e.lineno and 0 < e.lineno <= len(lines):
+                # replace raw text from file with actual code
+                e.text = lines[e.lineno - 1]
         # remove outer frames from traceback
         orig_tb = tb
         while (
@@ -55,3 +72,141 @@ def is_package(module_name: str) -> bool:
 def py_from_ppy_filename(filename: str) -> str:
     file_path = os.path.splitext(filename)[0]
     return file_path + ".py"
+
+
+def get_disabled(filename: str) -> Optional[bool]:
+    # always enable preprocessing of ppy files
+    if filename.endswith(tuple(FILE_EXTENSIONS)):
+        return False
+    # but disable other Python files
+    if filename.endswith(tuple(SOURCE_SUFFIXES)):
+        return True
+    return None
+
+
+def needs_preprocessing(
+    src: Union[str, bytes], filename: str, default_disabled: bool
+) -> bool:
+    # disabled preprocessor can only be enabled by #pragma pypp on
+    if (b"pypp" if isinstance(src, bytes) else "pypp") in src:
+        return True
+    disabled = get_disabled(filename)
+    if disabled is None:
+        disabled = default_disabled
+    return not disabled
+
+
+def write_atomic(path: str, *chunks: bytes) -> None:
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with open(fd, "wb") as f:
+            f.writelines(chunks)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class FileHashMemo:
+    """
+    Remembers hashes of files until their stat info changes,
+    so checking an unchanged file costs a single stat call
+    """
+
+    # files modified this recently may change again
+    # without changing their mtime, so they aren't remembered
+    RACY_INTERVAL_NS = 2 * 10**9
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        # files are hashed outside of the lock,
+        # it only guards replacing and serializing the dict
+        self._lock = threading.Lock()
+
+    def get_hash(self, file: str) -> bytes:
+        st = os.stat(file)
+        info = (st.st_mtime_ns, st.st_size, st.st_ino)
+        entry = self._data.get(file)
+        if entry is not None and entry[0] == info:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        with open(file, "rb") as f:
+            hash_ = source_hash(RAW_MAGIC_NUMBER, f.read())
+        if time.time_ns() - st.st_mtime_ns > self.RACY_INTERVAL_NS:
+            with self._lock:
+                self._data[file] = info, hash_
+        return hash_
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, "rb") as f:
+                data = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        with self._lock:
+            data.update(self._data)
+            self._data = data
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            dumped = marshal.dumps(self._data)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, dumped)
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+file_hashes = FileHashMemo()
+get_file_hash = file_hashes.get_hash
+
+
+class LRUCache:
+    """
+    A dict-like cache which drops least recently used entries
+    and counts hits and misses, safe to share between threads
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
@@ -1,3 +1,5 @@
+import gc
+import dis
 import os
 import sys
 import time
@@ -5,6 +7,8 @@ import _imp
 import shutil
 import py_compile
 from io import StringIO
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 from subprocess import STDOUT, CalledProcessError, check_output
 
@@ -14,8 +18,29 @@ TESTS_DIR = os.path.dirname(__file__)
 ROOT_DIR = os.path.dirname(TESTS_DIR)
 sys.path.insert(0, ROOT_DIR)
 
-from pwcp import main  # noqa: E402
-from pwcp.utils import is_package  # noqa: E402
+from pwcp import configure, get_included_files, main  # noqa: E402
+from pwcp.context import get_config  # noqa: E402
+from pwcp.utils import FileHashMemo, is_package  # noqa: E402
+from pwcp.preprocessor import (  # noqa: E402
+    PyPreprocessor,
+    header_cache,
+    maybe_preprocess,
+    preprocess_file,
+    preprocess_file_streaming,
+    preprocess_many,
+    preprocessed_files,
+    string_cache,
+)
+from pwcp import monkeypatch  # noqa: E402
+from pwcp.store import (  # noqa: E402
+    IndexedSource,
+    LineStore,
+    get_line_index_path,
+    write_line_index,
+)
+from pwcp.depgraph import DependencyGraph  # noqa: E402
+from pwcp import profiling  # noqa: E402
+from pwcp import daemon  # noqa: E402
 
 
 sys.dont_write_bytecode = True
@@ -239,6 +264,11 @@ def test_bytecode_caching(mode):
         )
     finally:
         os.remove(pyc2)
+        for path in (get_line_index_path(pyc2), "tests/bytecode_test.pyh"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
 
 def test_is_package():
@@ -246,3 +276,963 @@ def test_is_package():
     assert is_package("tests.test_modules") is False
     with pytest.warns(match="Module file or directory not found"):
         assert is_package("inexistent") is False
+
+
+def test_preprocessed_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    header = tmp_path / "header.pyh"
+    header.write_text("#define VALUE 1\n")
+    module = tmp_path / "module.ppy"
+    module.write_text('#include "header.pyh"\nprint(VALUE)\n')
+
+    res, deps = preprocess_file(str(module), cache_dir=cache_dir)
+    assert res.endswith("print(1)\n")
+    assert deps == [str(header)]
+    assert os.listdir(cache_dir)
+
+    with patch("pwcp.preprocessor.preprocess") as patched_preprocess:
+        assert preprocess_file(str(module), cache_dir=cache_dir) == (
+            res,
+            deps,
+        )
+        patched_preprocess.assert_not_called()
+
+    header.write_text("#define VALUE 2\n")
+    res, _ = preprocess_file(str(module), cache_dir=cache_dir)
+    assert res.endswith("print(2)\n")
+
+
+def test_header_cache(tmp_path):
+    header = tmp_path / "common.pyh"
+    header.write_text("#define ONE 1\n#define ADD(a, b) ((a) + (b))\n")
+    modules = []
+    for i in range(3):
+        module = tmp_path / f"module{i}.ppy"
+        module.write_text(f'#include "common.pyh"\nprint(ADD(ONE, {i}))\n')
+        modules.append(str(module))
+
+    header_cache.clear()
+    results = [preprocess_file(module)[0] for module in modules]
+    assert [res.splitlines()[-1] for res in results] == [
+        f"print(((1) + ({i})))" for i in range(3)
+    ]
+    assert (header_cache.hits, header_cache.misses) == (2, 1)
+
+    header.write_text("#define ONE 2\n#define ADD(a, b) ((a) + (b))\n")
+    assert preprocess_file(modules[0])[0].endswith("print(((2) + (0)))\n")
+    assert header_cache.misses == 2
+
+
+def test_pyc_trailer():
+    code = compile("x = 1", os.path.abspath("tests/hello.ppy"), "exec")
+    plain_pyc = bytes(monkeypatch.patched_code_to_timestamp_pyc(code, 1, 5))
+    monkeypatch.dependencies[code] = [os.path.abspath("tests/hello.pyh")]
+    pwcp_pyc = bytes(monkeypatch.patched_code_to_timestamp_pyc(code, 1, 5))
+    assert code not in monkeypatch.dependencies
+
+    with patch("pwcp.monkeypatch.marshal") as patched_marshal:
+        assert monkeypatch.read_pyc_trailer(plain_pyc) is None
+        monkeypatch.patched_validate_timestamp_pyc(plain_pyc, 1, 5, "", {})
+        patched_marshal.loads.assert_not_called()
+
+    assert monkeypatch.read_pyc_trailer(pwcp_pyc) == (
+        code.co_filename,
+        {os.path.abspath("tests/hello.pyh"): None},
+        None,
+    )
+
+
+def test_file_hash_memo(tmp_path):
+    file = tmp_path / "header.pyh"
+    file.write_text("#define X 1\n")
+    # recently modified files aren't remembered
+    memo = FileHashMemo()
+    hash1 = memo.get_hash(str(file))
+    assert memo.get_hash(str(file)) == hash1
+    assert (memo.hits, memo.misses) == (0, 2)
+
+    os.utime(file, ns=(0, 0))
+    memo.get_hash(str(file))
+    assert memo.get_hash(str(file)) == hash1
+    assert (memo.hits, memo.misses) == (1, 3)
+
+    memo.save(str(tmp_path / "hashes"))
+    memo = FileHashMemo()
+    memo.load(str(tmp_path / "hashes"))
+    assert memo.get_hash(str(file)) == hash1
+    assert memo.hits == 1
+
+    file.write_text("#define X 2\n")
+    os.utime(file, ns=(10**9, 10**9))
+    assert memo.get_hash(str(file)) != hash1
+
+
+def test_line_store():
+    text = "print(1)\n" * 100
+    store = LineStore(budget=len(text) * 2 + 10)
+    for i in range(5):
+        store[f"<string{i}>"] = text + str(i)
+    store["<failed>"] = None
+    assert store.size <= store.budget
+    assert len(store) == 6
+
+    assert store["<string0>"] == text + "0"
+    assert store["<failed>"] is None
+    assert store.get("<unknown>") is None
+    assert "<string4>" in store
+
+    del store["<string1>"]
+    assert "<string1>" not in store
+    assert sorted(store) == [
+        "<failed>",
+        "<string0>",
+        "<string2>",
+        "<string3>",
+        "<string4>",
+    ]
+
+
+def test_included_files():
+    with patch("sys.stdout", new=StringIO()):
+        main(["tests/test_modules.ppy"])
+    try:
+        assert get_included_files(sys.modules["hello"]) == [
+            os.path.abspath("tests/rick_astley.pyh")
+        ]
+        assert get_included_files(sys.modules["a_module.regular_py"]) == []
+    finally:
+        del sys.modules["hello"]
+    # nothing is kept when bytecode isn't written
+    gc.collect()
+    assert not monkeypatch.dependencies
+
+
+def test_string_cache():
+    code = "#pragma pypp on\n#define X 1\nx = X\n"
+    string_cache.clear()
+    res = maybe_preprocess(code, "<string>")
+    assert res.endswith("x = 1\n")
+
+    with patch("pwcp.preprocessor.preprocess") as patched_preprocess:
+        assert maybe_preprocess(code, "<string>") == res
+        patched_preprocess.assert_not_called()
+    assert (string_cache.hits, string_cache.misses) == (1, 1)
+    # only the output is kept
+    assert not any(code in key for key in string_cache._data)
+
+    # stateful preprocessors are never memoized
+    p = PyPreprocessor()
+    maybe_preprocess(code, "<string>", p)
+    assert "X" in p.macros
+    assert string_cache.hits == 1
+
+
+def test_disabled_passthrough():
+    assert not get_config().preprocess_unknown_sources
+    for src in ("x = 1 // 2", b"x = 1 // 2", "#define X 1\nx = 1"):
+        with patch("pwcp.preprocessor.preprocess") as patched_preprocess:
+            assert maybe_preprocess(src, "<passthrough>") is src
+            assert maybe_preprocess(src, "module.py") is src
+            patched_preprocess.assert_not_called()
+    assert "<passthrough>" not in preprocessed_files
+
+    src = "#pragma pypp on\n#define X 1\nx = X"
+    assert maybe_preprocess(src, "<passthrough>").endswith("x = 1")
+    assert maybe_preprocess(b"x = X", "module.ppy").endswith("x = X")
+
+
+def test_compileall(tmp_path):
+    header = tmp_path / "header.pyh"
+    header.write_text("#define VALUE 1\n")
+    for i in range(2):
+        (tmp_path / f"module{i}.ppy").write_text(
+            '#include "header.pyh"\nvalue = VALUE\n'
+        )
+
+    def run(*args):
+        with patch("sys.stdout", new=StringIO()):
+            assert main(["compileall", "-j", "2", str(tmp_path), *args]) == 0
+            return sorted(
+                line.split()[0] for line in sys.stdout.getvalue().splitlines()
+            )
+
+    assert run() == ["compiled", "compiled"]
+    assert run() == ["up-to-date", "up-to-date"]
+    assert run("--invalidation-mode", "checked-hash") == [
+        "compiled",
+        "compiled",
+    ]
+    assert run("--invalidation-mode", "checked-hash") == [
+        "up-to-date",
+        "up-to-date",
+    ]
+    header.write_text("#define VALUE 2\n")
+    assert run("--invalidation-mode", "checked-hash") == [
+        "compiled",
+        "compiled",
+    ]
+    # no temporary files are left, every pyc has a line index
+    assert sorted(
+        os.path.splitext(name)[1]
+        for name in os.listdir(tmp_path / "__pycache__")
+    ) == [".lines", ".lines", ".pyc", ".pyc"]
+
+
+def test_build(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    cache_dir = str(tmp_path / "cache")
+    header = src / "header.pyh"
+    header.write_text("#define VALUE 1\n")
+    (src / "uses_header.ppy").write_text('#include "header.pyh"\nv = VALUE\n')
+    (src / "standalone.ppy").write_text("v = 1\n")
+
+    def run(*options):
+        with patch("sys.stdout", new=StringIO()):
+            assert (
+                main(["build", "--cache-dir", cache_dir, *options, str(src)])
+                == 0
+            )
+            return sorted(
+                os.path.basename(line.split()[-1])
+                for line in sys.stdout.getvalue().splitlines()[1:]
+            )
+
+    assert run() == ["standalone.ppy", "uses_header.ppy"]
+    assert run() == []
+    header.write_text("#define VALUE 22\n")
+    assert run() == ["uses_header.ppy"]
+
+    # pycs built with other macros are tracked separately
+    assert run("-D", "DEBUG") == ["standalone.ppy", "uses_header.ppy"]
+    header.write_text("#define VALUE 333\n")
+    assert run("-D", "DEBUG") == ["uses_header.ppy"]
+    assert run() == ["uses_header.ppy"]
+
+    graph = DependencyGraph(os.path.join(cache_dir, "depgraph"))
+    assert graph.get_dependents(str(header)) == {str(src / "uses_header.ppy")}
+    assert graph.get_dependencies(str(src / "uses_header.ppy")) == [
+        str(header)
+    ]
+
+
+def test_profiling():
+    with patch.object(profiling, "enabled", True), patch.object(
+        profiling, "records", {}
+    ), patch("sys.stdout", new=StringIO()):
+        main(["tests/hello.ppy"])
+        record = profiling.records["__main__"]
+        assert record["preprocess"] > 0
+        assert record["compile"] > 0
+        assert record["includes"] == 1
+        header_lookups = record.get("header_misses", 0) + record.get(
+            "header_hits", 0
+        )
+        assert header_lookups == 1
+
+        out = StringIO()
+        profiling.dump(out)
+        assert out.getvalue().splitlines()[1].endswith("__main__")
+
+
+def test_benchmark(tmp_path):
+    results = tmp_path / "results.json"
+    with patch("sys.stdout", new=StringIO()):
+        assert (
+            main(
+                [
+                    "bench",
+                    "--modules=2",
+                    "--headers=2",
+                    "--fanout=1",
+                    "--macros=2",
+                    "--depth=1",
+                    "--repeat=1",
+                    "--scenario=cold_import",
+                    "--scenario=warm_pyc_import",
+                    "-o",
+                    str(results),
+                ]
+            )
+            == 0
+        )
+        assert main(["bench", "--compare", str(results), str(results)]) == 0
+        lines = sys.stdout.getvalue().splitlines()
+    assert lines[0].startswith("cold_import")
+    assert lines[-1].startswith("warm_pyc_import")
+    assert lines[-1].endswith("1.00")
+
+
+def test_daemon(tmp_path):
+    address = str(tmp_path / "pwcp.sock")
+    client = daemon.DaemonClient(address)
+    # no daemon, the work must be done in process
+    assert not client.ping()
+    assert client.compile("tests/hello.ppy", 0) is None
+
+    server = daemon.Server(address, daemon.RequestHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert client.ping()
+        with patch.object(daemon, "code_cache", daemon.LRUCache(1)):
+            with patch("sys.stdout", new=StringIO()):
+                main(["--daemon", address, "tests/hello.ppy"])
+                assert sys.stdout.getvalue() == "Hello world!\nNone world!\n"
+            assert daemon.code_cache.misses == 1
+            text, deps, code = client.compile(
+                os.path.abspath("tests/hello.ppy"), 0
+            )
+            assert daemon.code_cache.hits == 1
+
+            # compact code is compiled by the client
+            from pwcp.hooks import PPyLoader
+
+            path = os.path.abspath("tests/hello.ppy")
+            with configure(compact=True, daemon=address):
+                loader = PPyLoader("hello", path)
+                loader.source_to_code(loader.get_data(path), path)
+            assert loader._compact is not None
+            assert daemon.code_cache.misses == 1
+
+            # custom preprocessing functions run in the client
+            with configure(
+                daemon=address,
+                preprocessing_function=lambda src, filename, p: "v = 1\n",
+            ):
+                loader = PPyLoader("hello", path)
+                data = loader.get_data(path)
+            assert data == b"v = 1\n"
+            assert daemon.code_cache.misses == 1
+        assert 'print ( "Hello " "world!" )\n' in text
+        assert os.path.abspath("tests/rick_astley.pyh") in deps
+        assert client.compile("tests/missing.ppy", 0) is None
+
+        # the daemon uses precompiled headers of the client
+        from pwcp import pch
+
+        pch.headers.clear()
+        with configure(precompiled_headers=True):
+            assert client.preprocess("tests/hello.ppy")[0] == text
+        assert pch.headers.misses == 1
+
+        # requests of other versions fail, so clients preprocess files
+        from importlib.util import MAGIC_NUMBER
+        from socket import AF_UNIX, SOCK_STREAM, socket
+
+        with socket(AF_UNIX, SOCK_STREAM) as sock:
+            sock.connect(address)
+            daemon.send_message(
+                sock, (MAGIC_NUMBER, "0.0.0", os.getcwd(), "ping", ())
+            )
+            assert daemon.recv_message(sock) == (
+                False,
+                "ValueError: client uses another pwcp version",
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert not os.path.exists(address)
+
+
+def test_lazy_imports():
+    code = (
+        "import sys; from pwcp import main; main(['tests/hello.py']);"
+        "print(sorted({'pypp', 'argparse', 'pwcp.preprocessor'}"
+        " & set(sys.modules)))"
+    )
+    output = check_output(
+        [sys.executable, "-X", "importtime", "-c", code], stderr=STDOUT
+    ).splitlines()
+    # plain files are run without parsing options
+    assert b"[]" in output
+    imported = {
+        line.rpartition(b"|")[2].strip()
+        for line in output
+        if line.startswith(b"import time:")
+    }
+    assert b"typing" not in imported and b"pwcp.hooks" in imported
+    output = check_output(
+        [
+            sys.executable,
+            "-c",
+            "import pwcp, sys;" "print('pwcp.runner' in sys.modules)",
+        ]
+    )
+    assert output.strip() == b"False"
+
+
+def test_preprocessor_import_threads():
+    # source compiled by another thread while pypp is being imported
+    # must wait for the import instead of staying unpreprocessed
+    code = """
+import sys, time, threading
+from pwcp.context import set_default_config
+from pwcp.monkeypatch import maybe_preprocess
+
+set_default_config(preprocess_unknown_sources=True)
+started = threading.Event()
+
+class Finder:
+    def find_spec(self, name, path, target=None):
+        if name == "pypp":
+            started.set()
+            time.sleep(0.2)
+
+sys.meta_path.insert(0, Finder())
+thread = threading.Thread(target=__import__, args=("pwcp.preprocessor",))
+thread.start()
+started.wait()
+src = "#define X 1\\nx = X\\n"
+print(maybe_preprocess(src, "<thread>") != src)
+thread.join()
+"""
+    output = check_output([sys.executable, "-c", code])
+    assert output.strip() == b"True"
+
+
+def test_path_finder_index(tmp_path):
+    from pwcp.hooks import PPyPathFinder
+
+    (tmp_path / "plain.py").write_text("")
+    (tmp_path / "package").mkdir()
+    (tmp_path / "not_package").mkdir()
+    (tmp_path / "package" / "__init__.ppy").write_text("")
+    (tmp_path / "module.ppy").write_text("")
+    path = [str(tmp_path)]
+
+    with patch.object(PPyPathFinder, "index", {}), patch.object(
+        PPyPathFinder, "packages", {}
+    ):
+        assert PPyPathFinder.find_spec("module", path) is not None
+        assert PPyPathFinder.find_spec("package", path) is not None
+        assert PPyPathFinder.find_spec("plain", path) is None
+        assert PPyPathFinder.find_spec("not_package", path) is None
+        index = PPyPathFinder.index[str(tmp_path)]
+        assert index.modules == {"module"}
+        assert index.subdirs == {"package", "not_package"}
+        assert not PPyPathFinder.packages[str(tmp_path / "not_package")][1]
+
+        # changes are noticed by mtime of the directory
+        (tmp_path / "new.ppy").write_text("")
+        os.utime(tmp_path, ns=(0, index.mtime + 10**9))
+        (tmp_path / "not_package" / "__init__.ppy").write_text("")
+        os.utime(tmp_path / "not_package", ns=(0, 10**9))
+        assert PPyPathFinder.find_spec("new", path) is not None
+        assert PPyPathFinder.find_spec("not_package", path) is not None
+
+        PPyPathFinder.invalidate_caches()
+        assert not PPyPathFinder.index
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_preprocess_many(executor):
+    paths = [
+        os.path.abspath(os.path.join("tests", name))
+        for name in ("hello.ppy", "comments.ppy", "error_directive.ppy")
+    ]
+    results = {
+        result.path: result for result in preprocess_many(paths, 2, executor)
+    }
+    assert results.keys() == set(paths)
+
+    hello = results[paths[0]]
+    assert hello.error is None
+    assert hello.text == preprocess_file(paths[0])[0]
+    assert hello.dependencies == [os.path.abspath("tests/rick_astley.pyh")]
+    assert hello.elapsed > 0
+    assert preprocessed_files[paths[0]] == hello.text
+
+    failed = results[paths[2]]
+    assert failed.text is None and failed.error is not None
+    assert preprocessed_files[paths[2]] is None
+
+    with pytest.raises(ValueError):
+        list(preprocess_many(paths, executor="fiber"))
+
+
+def test_concurrency(tmp_path):
+    from importlib.util import module_from_spec
+    from pwcp.hooks import PPyPathFinder
+
+    (tmp_path / "common.pyh").write_text("#define BASE 10\n")
+    for i in range(8):
+        (tmp_path / f"threaded{i}.ppy").write_text(
+            f'#include "common.pyh"\n#define VALUE BASE + {i}\nvalue = VALUE\n'
+        )
+    store = LineStore(budget=1000)
+
+    def work(i: int):
+        results = []
+        for j in range(20):
+            # unknown sources are preprocessed only in half of the threads
+            src = f"#define V {i * 100 + j}\nv = V\n"
+            with configure(preprocess_unknown_sources=i % 2 == 0):
+                res = maybe_preprocess(src, f"<thread{i}-{j}>")
+                assert get_config().preprocess_unknown_sources == (i % 2 == 0)
+            if i % 2 == 0:
+                ns = {}
+                exec(res, ns)
+                results.append(ns["v"])
+            else:
+                assert res is src
+
+            store[f"{i}-{j}"] = str(j) * 50
+            assert store[f"{i}-{j}"] == str(j) * 50
+
+        spec = PPyPathFinder.find_spec(f"threaded{i}", [str(tmp_path)])
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return results, module.value
+
+    with ThreadPoolExecutor(8) as pool:
+        for i, (results, value) in enumerate(pool.map(work, range(8))):
+            if i % 2 == 0:
+                assert results == [i * 100 + j for j in range(20)]
+            assert value == 10 + i
+
+    # overrides don't leak into the default configuration
+    assert not get_config().preprocess_unknown_sources
+    assert len(store) == 160 and store.size <= store.budget
+
+
+def test_streaming(tmp_path):
+    body = "".join(
+        f'TABLE_{i} = (ROW({i}), """\n{i}\n""")  /* {i}\n */\n'
+        for i in range(200)
+    )
+    file = tmp_path / "table.ppy"
+    file.write_text(
+        '#include "table.pyh"\n' + body + "x = 1 + \\\n    2\n" + body
+    )
+    (tmp_path / "table.pyh").write_text("#define ROW(i) (i, i * 2)\n")
+
+    expected, expected_deps = preprocess_file(str(file))
+    for chunk_size in (1, 100, 10**6):
+        data, deps = preprocess_file_streaming(str(file), True, chunk_size)
+        assert data.decode() == expected
+        assert deps == expected_deps
+        assert (tmp_path / "table.py").read_text() == expected
+        # the line store receives the output without keeping it in memory
+        assert str(file) not in preprocessed_files._data
+        assert preprocessed_files[str(file)] == expected
+
+    sys.path.insert(0, str(tmp_path))
+    try:
+        with configure(stream_chunk_size=64):
+            import table
+    finally:
+        del sys.path[0]
+    assert table.TABLE_199 == ((199, 398), "\n199\n")
+    assert table.x == 3
+
+    # streamed output isn't cached
+    for options in (["--cache-dir", str(tmp_path)], ["--PCH"]):
+        with patch("sys.stderr", new=StringIO()) as stderr:
+            with pytest.raises(SystemExit):
+                main(["--stream", "64", *options, str(file)])
+        assert "--stream can't be used" in stderr.getvalue()
+
+
+def test_line_index(tmp_path):
+    from traceback import extract_tb
+    from importlib.util import module_from_spec
+    from pwcp.compileall import compile_file
+    from pwcp.hooks import PPyPathFinder, install
+
+    for text in ("", "a", "a\n", "a\n\nb", "a\nb\n\n", "\u00fc\n\u00f1"):
+        lines = IndexedSource(text)
+        assert list(lines) == text.splitlines()
+        write_line_index(str(tmp_path / "index"), text.encode())
+        mapped = IndexedSource.from_file(str(tmp_path / "index"))
+        assert list(mapped) == text.splitlines() and mapped.text == text
+    assert mapped[-1] == "\u00f1" and mapped[:5] == ["\u00fc", "\u00f1"]
+    (tmp_path / "broken").write_bytes(b"PWCPLIN")
+    assert IndexedSource.from_file(str(tmp_path / "broken")) is None
+
+    store = LineStore()
+    store["<a>"] = "x\ny"
+    assert store.get_lines("<a>") is store.get_lines("<a>")
+    assert store.get_lines("<a>")[1] == "y"
+    store.set_index_file("<a>", str(tmp_path / "index"))
+    assert store["<a>"] == mapped.text
+    assert store.get_lines("<a>")[0] == "\u00fc"
+
+    # mapped files are closed when they're evicted or deleted
+    lines = store.get_lines("<a>")
+    store.max_mapped_files = 1
+    store.set_index_file("<b>", str(tmp_path / "index"))
+    assert store.get_lines("<b>")[0] == "\u00fc"
+    assert lines._mapping is None and len(store._mapped) == 1
+    lines = store.get_lines("<b>")
+    del store["<b>"]
+    assert lines._mapping is None and not store._mapped
+    mapped.close()
+    with pytest.raises(ValueError):
+        mapped[0]
+
+    # tracebacks of modules loaded from pyc show preprocessed lines,
+    # pycs are found for pwcp modules when the hooks are installed
+    install(
+        save_files=False, prefer_python=False, preprocess_unknown_sources=False
+    )
+    (tmp_path / "indexed.ppy").write_text(
+        "#define VALUE 42\ndef fail():\n    raise ValueError(VALUE)\n"
+    )
+    path = str(tmp_path / "indexed.ppy")
+    assert compile_file(path).status == "compiled"
+    spec = PPyPathFinder.find_spec("indexed", [str(tmp_path)])
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert path in preprocessed_files._index_files
+    with pytest.raises(ValueError) as exc_info:
+        module.fail()
+    assert extract_tb(exc_info.tb)[-1].line == "raise ValueError(42)"
+
+    # without the index, lines are looked up as before
+    del preprocessed_files[path]
+    os.remove(get_line_index_path(spec.cached))
+    spec.loader.exec_module(module_from_spec(spec))
+    assert path not in preprocessed_files
+
+    # an index which can't be rewritten is removed with the outdated pyc
+    write_line_index(get_line_index_path(spec.cached), b"stale")
+    os.remove(spec.cached)
+    sys.dont_write_bytecode = False
+    try:
+        with patch("pwcp.hooks.write_line_index", side_effect=OSError):
+            spec.loader.exec_module(module_from_spec(spec))
+    finally:
+        sys.dont_write_bytecode = True
+    assert os.path.isfile(spec.cached)
+    assert not os.path.exists(get_line_index_path(spec.cached))
+
+
+def test_precompiled_headers(tmp_path):
+    from pwcp import pch
+
+    header = tmp_path / "common.pyh"
+    header.write_text(
+        "#ifndef COMMON\n#define COMMON\n#define VALUE 1\n#endif\n"
+    )
+    (tmp_path / "code.pyh").write_text("print(1)\n")
+    prelude = '#include "common.pyh"\n#define TWICE(x) ((x) * 2)\n\n'
+    modules = []
+    for i in range(3):
+        module = tmp_path / f"module{i}.ppy"
+        module.write_text(
+            prelude + f'#include "common.pyh"\nv = TWICE(VALUE) + {i}\n'
+        )
+        modules.append(str(module))
+    code_module = tmp_path / "code_module.ppy"
+    code_module.write_text('#include "code.pyh"\nv = 1\n')
+    modules.append(str(code_module))
+    expected = [preprocess_file(module) for module in modules]
+
+    cache_dir = str(tmp_path / "cache")
+    pch.headers.clear()
+    with configure(precompiled_headers=True, cache_dir=cache_dir):
+        assert [preprocess_file(module) for module in modules] == expected
+        assert (pch.headers.hits, pch.headers.misses) == (2, 2)
+        assert os.listdir(os.path.join(cache_dir, pch.PCH_DIR_NAME))
+
+        # headers producing code aren't precompiled
+        src = code_module.read_text()
+        prelude_text, count = pch.split_prelude(src)
+        assert count == 1
+        assert (
+            pch.get_precompiled_header(
+                prelude_text, str(code_module), PyPreprocessor(disabled=False)
+            )
+            is None
+        )
+
+        # the header is reloaded from disk in a new process
+        pch.headers.clear()
+        assert preprocess_file(modules[0]) == expected[0]
+        assert pch.headers.misses == 1 and len(pch.headers) == 1
+
+        header.write_text("#define VALUE 2\n")
+        os.utime(header, ns=(0, 10**9))
+        res, deps = preprocess_file(modules[1])
+        assert "v = ((2) * 2) + 1" in res
+        assert str(header) in deps
+
+
+def test_predefined_macros(tmp_path):
+    module = tmp_path / "flavour.ppy"
+    module.write_text(
+        "#ifdef DEBUG\nlevel = DEBUG\n#else\nlevel = 0\n#endif\n"
+        "#ifdef __PYPP__\nis_pypp = True\n#endif\n"
+        "value = TWICE(3)\n"
+    )
+    definitions = (("DEBUG", "2"), ("TWICE(x)", "((x) * 2)"))
+    with configure(macros=definitions):
+        res, _ = preprocess_file(str(module))
+        assert "level = 2" in res and "value = ((3) * 2)" in res
+        # predefined macros are reused by new preprocessors
+        assert preprocess_file(str(module))[0] == res
+    with configure(macros=definitions[1:] + (("__PYPP__", None),)):
+        res, _ = preprocess_file(str(module))
+        assert "level = 0" in res and "is_pypp" not in res
+
+    # every set of macros gets its own pycs, .py files aren't affected
+    py_file = str(tmp_path / "plain.py")
+    paths = set()
+    for macros in ((), definitions, definitions[:1]):
+        with configure(macros=macros):
+            paths.add(monkeypatch.patched_cache_from_source(str(module)))
+            assert monkeypatch.patched_cache_from_source(
+                py_file
+            ) == monkeypatch.cache_from_source(py_file)
+    assert len(paths) == 3
+
+    with patch("sys.stdout", new=StringIO()):
+        assert main(["compileall", "-D", "DEBUG=2", str(module)]) == 0
+        assert main(["compileall", "-D", "DEBUG", str(module)]) == 0
+        assert main(["compileall", str(module)]) == 0
+    assert len(os.listdir(tmp_path / "__pycache__")) == 6
+
+
+def test_compact(tmp_path):
+    from pwcp.hooks import PPyLoader
+
+    module = tmp_path / "compact_module.ppy"
+    module.write_text(
+        """#define DEBUG 0
+#define VERSION 0x030B
+
+def f(x):
+#if DEBUG
+    print(x)
+#endif
+    # comment
+    if DEBUG and x > 1:
+        trace(x)
+    if VERSION >= 0x030A and not DEBUG:
+        doc = '''
+
+multiline
+'''
+    return 1 / x
+"""
+    )
+    path = str(module)
+    text, _ = preprocess_file(path)
+    full_lines = text.splitlines()
+
+    with configure(compact=True):
+        loader = PPyLoader("compact_module", path)
+        data = loader.get_data(path)
+        code = loader.source_to_code(data, path)
+    namespace = {}
+    exec(code, namespace)
+    f_code = namespace["f"].__code__
+    # constant conditions are folded, disabled branches are dropped
+    assert not [
+        instr
+        for instr in dis.get_instructions(f_code)
+        if instr.opname == "COMPARE_OP" or instr.argval == "trace"
+    ]
+    assert "doc" in f_code.co_varnames
+
+    with pytest.raises(ZeroDivisionError) as e:
+        namespace["f"](0)
+    lineno = e.traceback[-1].lineno + 1
+    assert full_lines[lineno - 1] == "    return 1 / x"
+
+    lines = preprocessed_files.get_lines(path)
+    assert lines[lineno - 1] == "    return 1 / x"
+    # blank lines and comments are restored as empty lines
+    assert list(lines) == [
+        line if line.strip() and not line.lstrip().startswith("#") else ""
+        for line in full_lines
+    ]
+    assert len(loader._compact.text) < len(text)
+
+    index_path = str(tmp_path / "compact_module.lines")
+    write_line_index(index_path, *loader.get_line_data(data))
+    assert list(IndexedSource.from_file(index_path)) == list(lines)
+
+
+def test_compact_invalid_operation():
+    from pwcp.compact import compile_compact
+
+    # errors of folded operations are left to runtime, like compile does
+    code, _ = compile_compact("def f():\n    return 1 >> -1\n", "<test>")
+    namespace = {}
+    exec(code, namespace)
+    with pytest.raises(ValueError):
+        namespace["f"]()
+
+
+def test_source_map(tmp_path):
+    from pwcp import get_source_map
+    from pwcp.hooks import PPyLoader
+    from pwcp.sourcemap import SourceLocation, _source_maps, map_location
+
+    header = tmp_path / "map_header.pyh"
+    header.write_text("def inc(x):\n    return x + 1\n\n\n\n\nLAST = 1\n")
+    module = tmp_path / "map_module.ppy"
+    module.write_text(
+        'import os\n#include "map_header.pyh"\nx = 1\n'
+        + "#if 0\n" * 10
+        + "#endif\n" * 10
+        + "y = inc(x)\n"
+    )
+    path = str(module)
+    loader = PPyLoader("map_module", path)
+    data = loader.get_data(path)
+    code = loader.source_to_code(data, path)
+    lines = data.decode().splitlines()
+
+    def find(text):
+        return map_location(path, lines.index(text) + 1)
+
+    assert find("import os") == SourceLocation(path, 1)
+    assert find("    return x + 1") == (str(header), 2)
+    assert find("LAST = 1") == (str(header), 7)
+    assert find("x = 1") == (path, 3)
+    assert find("y = inc(x)") == (path, 24)
+    # unknown files are left as is
+    assert map_location("<not preprocessed>", 5) == ("<not preprocessed>", 5)
+
+    # the map is saved in pyc and restored when it's loaded
+    pyc_path = str(tmp_path / "map_module.pyc")
+    with open(pyc_path, "wb") as f:
+        f.write(monkeypatch.patched_code_to_timestamp_pyc(code, 0, len(data)))
+    source_map = get_source_map(path)
+    del _source_maps[path]
+    PPyLoader("map_module", path).get_data(pyc_path)
+    assert get_source_map(path) == source_map
+
+
+def test_warmup(tmp_path):
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+
+    from pwcp import get_source_map, install, warmup
+    from pwcp.hooks import PPyLoader
+
+    install(
+        save_files=False, prefer_python=False, preprocess_unknown_sources=False
+    )
+
+    package = tmp_path / "warm_pkg"
+    package.mkdir()
+    (package / "__init__.ppy").write_text("#define X 1\nx = X\n")
+    (package / "plugin.ppy").write_text("#define VALUE 42\nvalue = VALUE\n")
+    (tmp_path / "warm_plain.ppy").write_text("#define Y 2\ny = Y\n")
+    (tmp_path / "warm_process.ppy").write_text("#define Z 3\nz = Z\n")
+
+    async def warm(names):
+        return await asyncio.wrap_future(warmup(names))
+
+    names = ["warm_pkg.plugin", "warm_missing", "warm_pkg", "warm_plain"]
+    sys.path.insert(0, str(tmp_path))
+    try:
+        assert asyncio.run(warm(names)) == [
+            "warm_pkg.plugin",
+            "warm_pkg",
+            "warm_plain",
+        ]
+        # parent packages aren't imported by warmup
+        assert "warm_pkg" not in sys.modules
+        assert len(PPyLoader.warm_code) == 3
+
+        with ProcessPoolExecutor(1) as executor:
+            assert warmup(["warm_process"], executor).result() == [
+                "warm_process"
+            ]
+        path = str(tmp_path / "warm_process.ppy")
+        assert "z = 3" in preprocessed_files[path]
+        assert get_source_map(path).lookup(2) == (path, 2)
+
+        # nothing is preprocessed on import
+        with patch.object(PPyLoader, "get_data", side_effect=AssertionError):
+            import warm_pkg.plugin
+            import warm_plain
+            import warm_process
+        assert not PPyLoader.warm_code
+        assert warm_pkg.x == 1 and warm_pkg.plugin.value == 42
+        assert warm_plain.y == 2 and warm_process.z == 3
+    finally:
+        del sys.path[0]
+        for name in ("warm_pkg", "warm_pkg.plugin", "warm_plain"):
+            sys.modules.pop(name, None)
+        sys.modules.pop("warm_process", None)
+
+
+def test_bundle(tmp_path):
+    src = tmp_path / "src"
+    package = src / "bundled_pkg"
+    package.mkdir(parents=True)
+    (package / "bundled.pyh").write_text("#define VALUE 42\n")
+    (package / "__init__.ppy").write_text(
+        '#include "bundled.pyh"\nvalue = VALUE\n'
+    )
+    (package / "mod.ppy").write_text(
+        "#define FAIL() raise ValueError(VALUE)\n"
+        '#include "bundled.pyh"\ndef fail():\n    FAIL()\n'
+    )
+    (package / "helper.py").write_text("helper = 1\n")
+    (package / "data.txt").write_text("data")
+    output = str(tmp_path / "app.zip")
+    with patch("sys.stdout", new=StringIO()):
+        # the package is bundled under its name
+        assert main(["bundle", "-o", output, str(package)]) == 0
+    # sources aren't needed anymore
+    shutil.rmtree(src)
+
+    script = f"""
+import os, sys, traceback
+sys.path.insert(0, {ROOT_DIR!r})
+from pwcp import install
+install(
+    save_files=False, prefer_python=False, preprocess_unknown_sources=False
+)
+sys.path.insert(0, {output!r})
+# opening the bundle imports zipfile, which looks at the bundle again
+assert "zipfile" not in sys.modules
+import bundled_pkg.mod, bundled_pkg.helper
+assert bundled_pkg.value == 42 and bundled_pkg.helper.helper == 1
+import pkgutil, importlib.resources
+assert pkgutil.get_data("bundled_pkg", "data.txt") == b"data"
+if hasattr(importlib.resources, "files"):
+    data = importlib.resources.files(bundled_pkg).joinpath("data.txt")
+    assert data.read_text() == "data"
+path = os.path.join({output!r}, "bundled_pkg", "mod.ppy")
+assert bundled_pkg.mod.__file__ == path
+try:
+    bundled_pkg.mod.fail()
+except ValueError:
+    traceback.print_exc(file=sys.stdout)
+print("pypp" in sys.modules)
+"""
+    out = check_output([sys.executable, "-c", script], text=True)
+    assert "    raise ValueError(42)" in out.splitlines()
+    assert out.splitlines()[-1] == "False"
+
+    # plain zips on sys.path aren't kept open
+    import zipfile
+    from pwcp.bundle import Bundle, create_bundle
+
+    plain = str(tmp_path / "plain.zip")
+    with zipfile.ZipFile(plain, "w") as archive:
+        archive.writestr("plain.py", "")
+    close = zipfile.ZipFile.close
+    with patch.object(
+        zipfile.ZipFile, "close", autospec=True, side_effect=close
+    ) as patched_close:
+        # the traceback keeps the bundle alive, so it isn't closed by gc
+        with pytest.raises(ImportError) as exc_info:
+            Bundle(plain)
+        assert patched_close.called
+    del exc_info
+
+    old = str(tmp_path / "old.zip")
+    with patch("pwcp.bundle.__version__", "0.0"):
+        create_bundle(old, [])
+    with pytest.raises(ImportError, match="another version of pwcp"):
+        Bundle(old)